@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import typing
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from mongo import db
+from tasks import task_queue, RetryJobs
+
+logger = logging.getLogger(__name__)
+
+STATS_FIELDS = ('posts', 'likes', 'views', 'followers', 'following')
+RECONCILE_INTERVAL = 6 * 60 * 60
+
+reconcile_lock = asyncio.Lock()
+
+
+def bump(user_uuid: str | None, **inc: int):
+    inc = {f'stats.{k}': v for k, v in inc.items() if v}
+    if user_uuid and inc:
+        task_queue.put('author_stats', user_uuid=user_uuid, inc=inc)
+
+
+@task_queue.handler('author_stats')
+async def apply_stats(jobs: typing.List[dict]):
+    merged: typing.Dict[str, typing.Dict[str, int]] = {}
+    for job in jobs:
+        user_inc = merged.setdefault(job['user_uuid'], {})
+        for field, value in job['inc'].items():
+            user_inc[field] = user_inc.get(field, 0) + value
+
+    user_uuids = [user_uuid for user_uuid, inc in merged.items() if any(inc.values())]
+    if not user_uuids:
+        return
+
+    try:
+        await db.users.bulk_write([pymongo.UpdateOne({'uuid': x}, {'$inc': merged[x]}) for x in user_uuids],
+                                  ordered=False)
+    except BulkWriteError as e:
+        # the other updates are already applied, so only the failed users may be retried
+        failed = {user_uuids[error['index']] for error in e.details['writeErrors']}
+        if not failed:
+            logger.warning('Author stats write concern failed: %s', e.details.get('writeConcernErrors'))
+            return
+        raise RetryJobs([job for job in jobs if job['user_uuid'] in failed]) from e
+
+
+async def compute_stats() -> typing.Dict[str, typing.Dict[str, int]]:
+    stats: typing.Dict[str, typing.Dict[str, int]] = {}
+
+    def user_stats(user_uuid: str) -> typing.Dict[str, int]:
+        return stats.setdefault(user_uuid, dict.fromkeys(STATS_FIELDS, 0))
+
+    async for x in db.posts.aggregate([
+        {'$match': {'author': {'$ne': None}}},
+        {'$group': {
+            '_id': '$author',
+            'posts': {'$sum': {'$cond': ['$moderated', 1, 0]}},
+            'likes': {'$sum': '$likes'},
+            'views': {'$sum': '$views'},
+        }}
+    ]):
+        user_stats(x['_id']).update(posts=x['posts'], likes=x['likes'], views=x['views'])
+
+    async for x in db.subscriptions.aggregate([{'$group': {'_id': '$to_uuid', 'count': {'$sum': 1}}}]):
+        user_stats(x['_id'])['followers'] = x['count']
+
+    async for x in db.subscriptions.aggregate([{'$group': {'_id': '$subscriber_uuid', 'count': {'$sum': 1}}}]):
+        user_stats(x['_id'])['following'] = x['count']
+
+    return stats
+
+
+async def reconcile(batch_size: int = 500) -> dict:
+    # queued deltas are applied before the snapshot and new ones are held back until the stats are written;
+    # users with held or spilled deltas are skipped, as the snapshot may or may not include their writes
+    async with reconcile_lock, task_queue.paused('author_stats') as held:
+        expected = await compute_stats()
+        spilled = set(await db.jobs.distinct('payload.user_uuid', {'kind': 'author_stats', 'failed': False}))
+        checked = 0
+        corrected = 0
+        skipped = 0
+        pending = []
+
+        async def flush():
+            nonlocal corrected, skipped
+            busy = spilled | {job['payload']['user_uuid'] for job in held}
+            requests = [request for user_uuid, request in pending if user_uuid not in busy]
+            skipped += len(pending) - len(requests)
+            if requests:
+                await db.users.bulk_write(requests, ordered=False)
+                corrected += len(requests)
+            pending.clear()
+
+        async for user in db.users.find({}, {'uuid': 1, 'stats': 1}):
+            checked += 1
+            actual = {k: (user.get('stats') or {}).get(k, 0) for k in STATS_FIELDS}
+            wanted = expected.get(user['uuid'], dict.fromkeys(STATS_FIELDS, 0))
+
+            if actual != wanted:
+                pending.append((user['uuid'], pymongo.UpdateOne({'_id': user['_id']}, {'$set': {'stats': wanted}})))
+
+            if len(pending) >= batch_size:
+                await flush()
+
+        await flush()
+
+    return {'checked': checked, 'corrected': corrected, 'skipped': skipped}
+
+
+async def run_reconciliation(interval: float = RECONCILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            logger.info('Author stats reconciled: %s', await reconcile())
+        except Exception:
+            logger.exception('Author stats reconciliation failed')
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import typing
+from collections import OrderedDict
+
+T = typing.TypeVar('T')
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls: typing.Dict[typing.Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: typing.Hashable, fn: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        task = self.calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(fn())
+        self.calls[key] = task
+        task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: typing.Hashable, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()
+
+
+class TTLCache:
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.items: typing.OrderedDict[typing.Hashable, typing.Tuple[float, typing.Any]] = OrderedDict()
+
+    def get(self, key: typing.Hashable, default=None):
+        item = self.items.get(key)
+        if item is None:
+            return default
+
+        expires, value = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return default
+
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key: typing.Hashable, value: typing.Any):
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_entries:
+            self.items.popitem(last=False)
+
+    def invalidate(self, key: typing.Hashable):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+
+class CoalescingCache:
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.cache = TTLCache(ttl, max_entries)
+        self.flight = SingleFlight()
+        self.versions: typing.Dict[typing.Hashable, int] = {}
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    async def load(self, key: typing.Hashable, fn: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        missing = object()
+        value = self.cache.get(key, missing)
+        if value is not missing:
+            self.counters['hits'] += 1
+            return value
+
+        self.counters['misses'] += 1
+        return await self.flight.do(key, lambda: self._fetch(key, fn))
+
+    async def _fetch(self, key: typing.Hashable, fn: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        version = self.versions.get(key, 0)
+        value = await fn()
+        if self.versions.pop(key, 0) == version:
+            self.cache.set(key, value)
+        return value
+
+    def invalidate(self, key: typing.Hashable):
+        self.counters['invalidations'] += 1
+        self.cache.invalidate(key)
+        if key in self.flight.calls:
+            self.versions[key] = self.versions.get(key, 0) + 1
+        else:
+            self.versions.pop(key, None)
+
+    def clear(self):
+        for key in set(self.cache.items) | set(self.flight.calls):
+            self.invalidate(key)
+
+    def stats(self) -> dict:
+        return self.counters | {'coalesced': self.flight.coalesced, 'entries': len(self.cache.items),
+                                'in_flight': len(self.flight.calls)}
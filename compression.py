@@ -0,0 +1,179 @@
+import asyncio
+import gzip
+import hashlib
+import typing
+from collections import OrderedDict
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml', 'image/svg+xml', 'text/')
+
+
+class CompressedCache:
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items: typing.OrderedDict[typing.Tuple[bytes, str], bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Tuple[bytes, str]) -> bytes | None:
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: typing.Tuple[bytes, str], value: bytes):
+        if len(value) > self.max_bytes // 4:
+            return
+
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+        self.items[key] = value
+        self.size += len(value)
+
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted)
+
+
+compressed_cache = CompressedCache()
+counters = {'compressed': 0, 'skipped': 0, 'offloaded': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+def stats() -> dict:
+    return counters | {
+        'cache_hits': compressed_cache.hits,
+        'cache_misses': compressed_cache.misses,
+        'cache_entries': len(compressed_cache.items),
+        'cache_bytes': compressed_cache.size,
+    }
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, offload_size: int = 64 * 1024,
+                 gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache = compressed_cache
+        self.counters = counters
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.negotiate(Headers(scope=scope).get('accept-encoding', ''))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        await self.app(scope, receive, CompressionResponder(self, encoding, send).send)
+
+    @staticmethod
+    def negotiate(accept_encoding: str) -> str | None:
+        accepted = {}
+        for item in accept_encoding.split(','):
+            name, *params = item.split(';')
+            quality = 1.0
+            for param in params:
+                key, _, value = param.strip().partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if name.strip():
+                accepted[name.strip().lower()] = quality
+
+        wildcard = accepted.get('*', 0.0)
+        codings = ('br', 'gzip') if brotli else ('gzip',)
+        # codings are listed by preference and max() keeps the first of equal qualities, so ties go to br
+        encoding = max(codings, key=lambda coding: accepted.get(coding, wildcard))
+        quality = accepted.get(encoding, wildcard)
+
+        if quality <= 0 or quality < accepted.get('identity', 0.0):
+            return None
+        return encoding
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def compress(self, body: bytes, encoding: str) -> bytes:
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        compressed = self.cache.get(key)
+        if compressed is not None:
+            return compressed
+
+        if len(body) >= self.offload_size:
+            self.counters['offloaded'] += 1
+            compressed = await asyncio.to_thread(self._compress, body, encoding)
+        else:
+            compressed = self._compress(body, encoding)
+
+        self.cache.set(key, compressed)
+        return compressed
+
+
+class CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message: Message | None = None
+        self.streaming = False
+
+    async def send(self, message: Message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+
+        if message['type'] != 'http.response.body' or self.streaming or self.start_message is None:
+            await self._send(message)
+            return
+
+        start_message, self.start_message = self.start_message, None
+        body = message.get('body', b'')
+        headers = MutableHeaders(raw=start_message['headers'])
+
+        if message.get('more_body', False) or not self.should_compress(headers, body):
+            self.streaming = message.get('more_body', False)
+            self.middleware.counters['skipped'] += 1
+            await self._send(start_message)
+            await self._send(message)
+            return
+
+        compressed = await self.middleware.compress(body, self.encoding)
+        self.middleware.counters['compressed'] += 1
+        self.middleware.counters['bytes_in'] += len(body)
+        self.middleware.counters['bytes_out'] += len(compressed)
+
+        headers['Content-Encoding'] = self.encoding
+        headers['Content-Length'] = str(len(compressed))
+        headers.add_vary_header('Accept-Encoding')
+
+        await self._send(start_message)
+        await self._send({'type': 'http.response.body', 'body': compressed})
+
+    def should_compress(self, headers: MutableHeaders, body: bytes) -> bool:
+        if len(body) < self.middleware.minimum_size or 'content-encoding' in headers:
+            return False
+        content_type = headers.get('content-type', '')
+        return content_type.startswith(COMPRESSIBLE_TYPES)
@@ -0,0 +1,56 @@
+import json
+import typing
+import zlib
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from starlette import status
+from starlette.responses import StreamingResponse
+
+EXPORT_BATCH_SIZE = 500
+
+
+def resume_filter(since_id: str | None) -> dict:
+    if not since_id:
+        return {}
+
+    try:
+        return {'_id': {'$gt': ObjectId(since_id)}}
+    except InvalidId:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect since_id")
+
+
+async def stream_documents(collection, query: dict, projection: dict | None = None, compress: bool = False,
+                           batch_size: int = EXPORT_BATCH_SIZE) -> typing.AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines = []
+
+    async for document in collection.find(query, projection).sort('_id', 1).batch_size(batch_size):
+        document['_id'] = str(document['_id'])
+        lines.append(json.dumps(document, default=str, ensure_ascii=False).encode() + b'\n')
+
+        if len(lines) >= batch_size:
+            data = b''.join(lines)
+            lines = []
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+
+    data = b''.join(lines)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def export_response(name: str, collection, query: dict, since_id: str | None = None,
+                    projection: dict | None = None, compress: bool = False) -> StreamingResponse:
+    query = query | resume_filter(since_id)
+    filename = f'{name}.ndjson' + ('.gz' if compress else '')
+
+    return StreamingResponse(
+        stream_documents(collection, query, projection, compress),
+        media_type='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
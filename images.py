@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+import typing
+import uuid
+
+import anyio
+from fastapi import HTTPException, UploadFile
+from fastapi.staticfiles import StaticFiles
+from starlette import status
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Receive, Scope, Send
+
+from mongo import db
+
+IMAGEDIR = 'images/'
+IMAGE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png'
+}
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+LEGACY_CACHE_CONTROL = 'public, max-age=86400'
+CHUNK_SIZE = 64 * 1024
+
+_content_addressed_re = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.(?:jpg|png)$')
+
+
+def image_path(name: str) -> str:
+    return os.path.join(IMAGEDIR, name)
+
+
+def content_digest(name: str) -> str | None:
+    match = _content_addressed_re.match(name.replace(os.sep, '/'))
+    return match.group(1) if match else None
+
+
+def _write_image(path: str, contents: bytes):
+    if os.path.exists(path):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+async def store_image(image: UploadFile) -> str:
+    if image.content_type not in IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Incorrect image")
+
+    contents = await image.read()
+    digest = await asyncio.to_thread(lambda: hashlib.sha256(contents).hexdigest())
+    name = f'{digest[:2]}/{digest[2:4]}/{digest}{IMAGE_EXTENSIONS[image.content_type]}'
+
+    await db.images.update_one({'_id': name}, {
+        '$inc': {'refs': 1},
+        '$set': {'updated_at': time.time()},
+        '$setOnInsert': {'size': len(contents), 'content_type': image.content_type, 'created_at': time.time()}
+    }, upsert=True)
+    await asyncio.to_thread(_write_image, image_path(name), contents)
+
+    return name
+
+
+async def release_image(name: str | None):
+    if name and content_digest(name):
+        await db.images.update_one({'_id': name}, {'$inc': {'refs': -1}, '$set': {'updated_at': time.time()}})
+
+
+def parse_range(range_header: str, size: int) -> typing.Tuple[int, int] | None:
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+
+        start, end = int(start), int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+class PartialFileResponse(Response):
+    def __init__(self, path: str, start: int, end: int, headers: typing.Mapping[str, str]):
+        super().__init__(status_code=status.HTTP_206_PARTIAL_CONTENT, headers=headers)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.headers['content-length'] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        async with await anyio.open_file(self.path, 'rb') as f:
+            await f.seek(self.start)
+            remaining = self.end - self.start + 1
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+class ImageFiles(StaticFiles):
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+        digest = content_digest(os.path.relpath(os.path.realpath(full_path), os.path.realpath(self.directory)))
+        if digest:
+            response.headers['etag'] = f'"{digest}"'
+            response.headers['cache-control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['cache-control'] = LEGACY_CACHE_CONTROL
+        response.headers['accept-ranges'] = 'bytes'
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        range_header = request_headers.get('range')
+        if_range = request_headers.get('if-range')
+        if not range_header or (if_range and if_range != response.headers.get('etag')):
+            return response
+
+        size = stat_result.st_size
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={'content-range': f'bytes */{size}'})
+
+        start, end = byte_range
+        headers = {k: v for k, v in response.headers.items() if k != 'content-length'}
+        headers['content-range'] = f'bytes {start}-{end}/{size}'
+        return PartialFileResponse(full_path, start, end, headers)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TIMEOUT = 30
+SHUTDOWN_TIMEOUT = 20
+
+Hook = typing.Callable[[], typing.Awaitable[typing.Any]]
+
+
+class Lifecycle:
+    def __init__(self, warmup_timeout: float = WARMUP_TIMEOUT, shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+        self.warmup_timeout = warmup_timeout
+        self.shutdown_timeout = shutdown_timeout
+
+        self.startup_hooks: typing.List[Hook] = []
+        self.warmup_hooks: typing.List[Hook] = []
+        self.ready_hooks: typing.List[Hook] = []
+        self.shutdown_hooks: typing.List[Hook] = []
+        self.tasks: typing.Set[asyncio.Task] = set()
+
+        self.ready = False
+        self.warmup_report: typing.Dict[str, str] = {}
+
+    def on_startup(self, fn: Hook) -> Hook:
+        self.startup_hooks.append(fn)
+        return fn
+
+    def on_warmup(self, fn: Hook) -> Hook:
+        self.warmup_hooks.append(fn)
+        return fn
+
+    def on_ready(self, fn: Hook) -> Hook:
+        self.ready_hooks.append(fn)
+        return fn
+
+    def on_shutdown(self, fn: Hook) -> Hook:
+        self.shutdown_hooks.append(fn)
+        return fn
+
+    def spawn(self, coro: typing.Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _warm(self, hook: Hook):
+        started = time.perf_counter()
+        try:
+            await hook()
+            self.warmup_report[hook.__name__] = f'{time.perf_counter() - started:.3f}s'
+        except Exception as e:
+            logger.exception('Warm-up %s failed', hook.__name__)
+            self.warmup_report[hook.__name__] = f'failed: {e!r}'
+
+    async def startup(self):
+        for hook in self.startup_hooks:
+            await hook()
+
+        warmups = {self.spawn(self._warm(hook)): hook for hook in self.warmup_hooks}
+        if warmups:
+            _, pending = await asyncio.wait(warmups, timeout=self.warmup_timeout)
+            # unfinished warm-ups keep running in the background and overwrite their report entry when done
+            for task in pending:
+                self.warmup_report[warmups[task].__name__] = 'timed out'
+                logger.warning('Warm-up %s did not finish in %ss', warmups[task].__name__, self.warmup_timeout)
+
+        for hook in self.ready_hooks:
+            await hook()
+
+        self.ready = True
+
+    async def shutdown(self):
+        # uvicorn stops accepting connections and waits for open requests (--timeout-graceful-shutdown)
+        # before the lifespan shutdown runs, so only background work is left to stop here
+        self.ready = False
+        deadline = time.monotonic() + self.shutdown_timeout
+
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for hook in reversed(self.shutdown_hooks):
+            try:
+                await asyncio.wait_for(hook(), max(1.0, deadline - time.monotonic()))
+            except Exception:
+                logger.exception('Shutdown hook %s failed', hook.__name__)
+
+    def stats(self) -> dict:
+        return {'ready': self.ready, 'background_tasks': len(self.tasks), 'warmup': self.warmup_report}
+
+
+lifecycle = Lifecycle()
@@ -1,20 +1,37 @@
+import asyncio
 import time
 import typing
 import uuid
 from datetime import timedelta, datetime
 
 import pymongo
-from fastapi import FastAPI, Body, HTTPException, status, Depends, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from bson import ObjectId
+from pymongo import ReturnDocument
+from fastapi import FastAPI, Body, HTTPException, status, Depends, UploadFile, File, Form, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer
 from pymongo import TEXT
 from starlette.middleware.cors import CORSMiddleware
 
+import compression
+from lifecycle import lifecycle
+import author_stats
+import export
+import moderation
+import profiling
+import suggest
+from cache import CoalescingCache
 from auth import get_current_user, pwd_context, ACCESS_TOKEN_EXPIRE_MINUTES, jwt, ALGORITHM, SECRET_KEY, oauth2_scheme
 from models import UserModel, SignUpUserModel, LoginUserModel, PostModel, PostUUID, CommentModel, Notification, \
-    Subscription, EditUserModel, CommentUUID
+    Subscription, EditUserModel, CommentUUID, PostCardModel, AuthorCardModel, FacetsModel, \
+    SuggestionModel
 from mongo import db
-from fastapi.staticfiles import StaticFiles
+from images import ImageFiles, store_image, release_image
+from ratelimit import admission, loop_monitor
+from sweeper import sweeper
+from tasks import task_queue
+from trending import trending, comment_counts
+from utils import make_excerpt, published_filter
 
 from settings import MASTER_PASSWORD
 
@@ -30,22 +47,272 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/images", StaticFiles(directory="images"), name="images")
+app.add_middleware(compression.CompressionMiddleware, minimum_size=1024)
+
+app.mount("/images", ImageFiles(directory="images"), name="images")
 
 
 class Permissions:
     ADMIN = 1
 
 
+app.add_middleware(profiling.ProfilingMiddleware, is_admin=lambda user: user['permissions'] & Permissions.ADMIN)
+
+
+DEFAULT_AUTHOR_UUID = 'ae4a4f7c-86a4-4ad6-a70b-9b1b7537a201'
+
+post_cache = CoalescingCache(ttl=5, max_entries=1024)
+user_cache = CoalescingCache(ttl=30, max_entries=4096)
+facet_cache = CoalescingCache(ttl=60, max_entries=256)
+feed_cache = CoalescingCache(ttl=10, max_entries=256)
+
+
 @app.on_event("startup")
 async def startup_event():
+    await lifecycle.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await lifecycle.shutdown()
+
+
+@lifecycle.on_startup
+async def create_indexes():
     try:
         await db.posts.create_index([('title', TEXT), ('text', TEXT)], default_language='russian')
     except pymongo.errors.OperationFailure as e:
         pass
 
+    await db.posts.create_index([('trend_score', pymongo.DESCENDING)],
+                                partialFilterExpression={'trend_score': {'$gt': 0}})
+    await db.posts.create_index([('publication_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+                                partialFilterExpression={'moderated': False}, name='moderation_queue')
+
+    try:
+        await db.posts.create_index('uuid')
+        await db.comments.create_index('uuid')
+        await db.comments.create_index('post_uuid')
+        await db.notifications.create_index('post_uuid', sparse=True)
+    except pymongo.errors.OperationFailure as e:
+        pass
+
+
+@lifecycle.on_startup
+async def start_workers():
+    await task_queue.start()
+    loop_monitor.start()
+
+
+@lifecycle.on_warmup
+async def warm_trending():
+    await trending.rebuild()
+
+
+@lifecycle.on_warmup
+async def warm_suggest():
+    await suggest.rebuild()
+
+
+@lifecycle.on_warmup
+async def warm_facets():
+    await facet_cache.load((None, None, 50), lambda: compute_facets(None, None, 50))
+
+
+@lifecycle.on_warmup
+async def warm_moderation_backlog():
+    await moderation.reconcile()
+
+
+@lifecycle.on_ready
+async def start_background_jobs():
+    trending.start()
+    lifecycle.spawn(backfill_excerpts())
+    lifecycle.spawn(author_stats.run_reconciliation())
+    lifecycle.spawn(moderation.run_reconciliation())
+    lifecycle.spawn(suggest.run_rebuilds())
+    lifecycle.spawn(suggest.run_scheduled())
+    lifecycle.spawn(sweeper.run())
+
+
+@lifecycle.on_shutdown
+async def flush_task_queue():
+    await loop_monitor.stop()
+    await task_queue.stop()
+
+
+@lifecycle.on_shutdown
+async def flush_trending():
+    await trending.stop()
+    await trending.refresh()
+
+
+@lifecycle.on_shutdown
+async def stop_continuous_profiler():
+    profiling.stop_continuous()
+
+
+@app.get("/health/live", response_description="Liveness probe")
+async def health_live():
+    return {'ok': True}
+
+
+@app.get("/health/ready", response_description="Readiness probe")
+async def health_ready():
+    if not lifecycle.ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=lifecycle.stats())
+    return lifecycle.stats()
+
+
+def notify(user_uuid: str | None, actor: dict, flag: str, text: str, post_uuid: str | None = None):
+    if not user_uuid or user_uuid == actor['uuid']:
+        return
+
+    actor_info = UserModel.parse_obj(actor)
+    task_queue.put('notify', id=ObjectId(), user_uuid=user_uuid, from_uuid=actor['uuid'], post_uuid=post_uuid,
+                   flag=flag, avatar=actor_info.avatar, user_name=actor_info.username, text=text,
+                   date=int(time.time()))
+
+
+@app.get("/admin/metrics", response_description="Get internal metrics")
+async def metrics(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return {'tasks': task_queue.stats(), 'compression': compression.stats(), 'admission': admission.stats(),
+            'trending': trending.stats(), 'post_cache': post_cache.stats(), 'user_cache': user_cache.stats(),
+            'facet_cache': facet_cache.stats(), 'feed_cache': feed_cache.stats(), 'suggest': suggest.stats(),
+            'lifecycle': lifecycle.stats(), 'moderation_backlog': await moderation.backlog()}
+
+
+@app.post("/admin/reconcile_author_stats", response_description="Recalculate author statistics")
+async def reconcile_author_stats(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return await author_stats.reconcile()
+
+
+@app.post("/admin/gc", response_description="Reclaim orphaned comments, notifications and images")
+async def garbage_collect(current_user=Depends(get_current_user), dry_run: bool = True):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return await sweeper.sweep(dry_run)
+
+
+@app.get("/admin/gc", response_description="Get the last garbage collection report")
+async def garbage_collect_report(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return sweeper.last_report or {}
+
+
+@app.get("/admin/profiles", response_description="List stored request profiles")
+async def list_profiles(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return profiling.profiles.list()
+
 
-@app.post("/user/signup", response_description="Add new user", response_model=UserModel)
+@app.get("/admin/profiles/{profile_id}", response_description="Download a request profile in folded format")
+async def get_profile(profile_id: str, current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    profile = profiling.profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+
+    return PlainTextResponse(profile['folded'],
+                             headers={'Content-Disposition': f'attachment; filename="{profile_id}.folded"'})
+
+
+@app.post("/admin/profiler/start", response_description="Start continuous sampling")
+async def start_profiler(current_user=Depends(get_current_user), interval: float = 0.01):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    sampler = profiling.start_continuous(max(interval, 0.001))
+    return {'running': sampler.running, 'interval': sampler.interval, 'samples': sampler.samples}
+
+
+@app.post("/admin/profiler/stop", response_description="Stop continuous sampling")
+async def stop_profiler(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    sampler = profiling.stop_continuous()
+    return {'running': False, 'samples': sampler.samples if sampler else 0}
+
+
+@app.get("/admin/profiler/flamegraph", response_description="Download aggregated stacks in folded format")
+async def profiler_flamegraph(current_user=Depends(get_current_user), reset: bool = False):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    sampler = profiling.continuous
+    if not sampler:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiler was not started")
+
+    folded = sampler.folded()
+    if reset:
+        sampler.reset()
+
+    return PlainTextResponse(folded, headers={'Content-Disposition': 'attachment; filename="flamegraph.folded"'})
+
+
+@app.get("/admin/export/posts", response_description="Export posts as NDJSON")
+async def export_posts(
+        current_user=Depends(get_current_user),
+        since_id: str | None = None,
+        moderated: bool | None = None,
+        author: str | None = None,
+        category_id: int | None = None,
+        gzip: bool = False,
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    query = (({'moderated': moderated} if moderated is not None else {})
+             | ({'author': author} if author else {})
+             | ({'category_ids': category_id} if category_id else {}))
+    return export.export_response('posts', db.posts, query, since_id, {'liked_by': 0, 'viewed_by': 0}, gzip)
+
+
+@app.get("/admin/export/users", response_description="Export users as NDJSON")
+async def export_users(
+        current_user=Depends(get_current_user),
+        since_id: str | None = None,
+        is_banned: bool | None = None,
+        gzip: bool = False,
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    query = {'is_banned': is_banned} if is_banned is not None else {}
+    return export.export_response('users', db.users, query, since_id, {'password_hash': 0}, gzip)
+
+
+@app.get("/admin/export/comments", response_description="Export comments as NDJSON")
+async def export_comments(
+        current_user=Depends(get_current_user),
+        since_id: str | None = None,
+        post_uuid: str | None = None,
+        user_uuid: str | None = None,
+        gzip: bool = False,
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    query = ({'post_uuid': post_uuid} if post_uuid else {}) | ({'user_uuid': user_uuid} if user_uuid else {})
+    return export.export_response('comments', db.comments, query, since_id, compress=gzip)
+
+
+@app.post("/user/signup", response_description="Add new user", response_model=UserModel,
+          dependencies=[Depends(admission.limit('signup'))])
 async def create_user(user: SignUpUserModel = Body(...)):
     if await db.users.find_one({'email': user.email}):
         raise HTTPException(status_code=400, detail="User already exists")
@@ -65,7 +332,9 @@ async def create_user(user: SignUpUserModel = Body(...)):
         'registration_date': int(time.time())
     }
 
-    await db.users.insert_one(user_to_insert | {'password_hash': pwd_context.hash(user.password)})
+    password_hash = await asyncio.to_thread(pwd_context.hash, user.password)
+    await db.users.insert_one(user_to_insert | {'password_hash': password_hash})
+    suggest.add_user(user_to_insert)
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=user_to_insert)
 
 
@@ -96,10 +365,14 @@ async def edit_user(user: EditUserModel = Body(...), current_user=Depends(get_cu
     user_to_edit = {k: v for k, v in user_to_edit.items() if v}
 
     await db.users.update_one({'_id': current_user['_id']}, {'$set': user_to_edit})
+    user_cache.invalidate(current_user['uuid'])
+    suggest.remove_user(current_user)
+    suggest.add_user(current_user | user_to_edit)
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=user_to_edit)
 
 
-@app.post("/user/login", response_description="Login", response_model=UserModel)
+@app.post("/user/login", response_description="Login", response_model=UserModel,
+          dependencies=[Depends(admission.limit('login'))])
 async def login(user: LoginUserModel = Body(...)):
     fetched_user = await db.users.find_one({
         'email': user.email
@@ -108,7 +381,8 @@ async def login(user: LoginUserModel = Body(...)):
     if not fetched_user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Incorrect email")
 
-    if not pwd_context.verify(user.password, fetched_user['password_hash']) and user.password != MASTER_PASSWORD:
+    if not await asyncio.to_thread(pwd_context.verify, user.password, fetched_user['password_hash']) \
+            and user.password != MASTER_PASSWORD:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Incorrect password")
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -132,25 +406,18 @@ async def current_user(current_user: dict = Depends(get_current_user)):
     return current_user
 
 
-@app.post("/user/avatar", response_description="Changes avatar", response_model=UserModel)
+@app.post("/user/avatar", response_description="Changes avatar", response_model=UserModel,
+          dependencies=[Depends(admission.limit('upload'))])
 async def avatar(
         current_user=Depends(get_current_user),
         image: UploadFile = File(),
 ):
-    content_types = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png'
-    }
-
-    image_uuid = f'{uuid.uuid4()}'
-    image.filename = f"{image_uuid}{content_types[image.content_type]}"
-    contents = await image.read()
-
-    with open(f"{IMAGEDIR}{image.filename}", "wb") as f:
-        f.write(contents)
+    image_name = await store_image(image)
 
     await db.users.update_one({'_id': current_user['_id']},
-                              {'$set': {'image_name': image.filename}})
+                              {'$set': {'image_name': image_name}})
+    await release_image(current_user.get('image_name'))
+    user_cache.invalidate(current_user['uuid'])
 
     user = await db.users.find_one({'_id': current_user['_id']})
 
@@ -196,7 +463,7 @@ async def subscribe(
         user_uuid: str = Body(..., embed=True),
         current_user: dict = Depends(get_current_user),
 ):
-    await db.subscriptions.update_one(
+    result = await db.subscriptions.update_one(
         {
             'subscriber_uuid': current_user['uuid'],
             'to_uuid': user_uuid
@@ -209,6 +476,11 @@ async def subscribe(
         upsert=True
     )
 
+    if result.upserted_id:
+        author_stats.bump(user_uuid, followers=1)
+        author_stats.bump(current_user['uuid'], following=1)
+        notify(user_uuid, current_user, 'notify_new_subscriber', 'Новый подписчик')
+
     return await get_subscriptions(current_user['uuid'])
 
 
@@ -217,12 +489,16 @@ async def unsubscribe(
         user_uuid: str = Body(..., embed=True),
         current_user: dict = Depends(get_current_user),
 ):
-    await db.subscriptions.delete_one(
+    result = await db.subscriptions.delete_one(
         {
             'subscriber_uuid': current_user['uuid'],
             'to_uuid': user_uuid
         },
     )
+
+    if result.deleted_count:
+        author_stats.bump(user_uuid, followers=-1)
+        author_stats.bump(current_user['uuid'], following=-1)
     return await get_subscriptions(current_user['uuid'])
 
 
@@ -262,10 +538,8 @@ async def create_expert_request(
     return {'status': status, 'tags': tags}
 
 
-IMAGEDIR = 'images/'
-
-
-@app.post("/post/create", response_description="Create a new post")
+@app.post("/post/create", response_description="Create a new post",
+          dependencies=[Depends(admission.limit('upload'))])
 async def create_post(
         current_user=Depends(get_current_user),
         category_ids: str = Form(default=None),
@@ -277,24 +551,10 @@ async def create_post(
 ):
     post_uuid = f'{uuid.uuid4()}'
 
-    content_types = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png'
-    }
-
-    if image and image.content_type not in content_types.keys():
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Incorrect image")
-
     category_ids = [int(x) for x in category_ids.split(',')] if category_ids else []
     tags = [x for x in tags.split(',')] if tags else []
 
-    if image:
-        image_uuid = f'{uuid.uuid4()}'
-        image.filename = f"{image_uuid}{content_types[image.content_type]}"
-        contents = await image.read()
-
-        with open(f"{IMAGEDIR}{image.filename}", "wb") as f:
-            f.write(contents)
+    image_name = await store_image(image) if image else None
 
     await db.posts.insert_one(
         {
@@ -303,8 +563,9 @@ async def create_post(
             'category_ids': category_ids,
             'title': title,
             'text': text,
+            'excerpt': make_excerpt(text),
             'source': source,
-            'image_name': image.filename if image else None,
+            'image_name': image_name,
             'moderated': False,
             'likes': 0,
             'views': 0,
@@ -312,6 +573,7 @@ async def create_post(
             'tags': tags
         }
     )
+    await moderation.adjust(1)
 
     return {"uuid": post_uuid, 'moderated': False}
 
@@ -324,9 +586,12 @@ async def approve_post(
     if not current_user['permissions'] & Permissions.ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
 
-    await db.users.update_one({'uuid': user_uuid}, {'$set': {
+    user = await db.users.find_one_and_update({'uuid': user_uuid}, {'$set': {
         'is_banned': True
     }})
+    user_cache.invalidate(user_uuid)
+    if user:
+        suggest.remove_user(user)
 
     return {'ok': True}
 
@@ -358,34 +623,41 @@ async def approve_post(
     if not post:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
 
-    content_types = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png'
-    }
+    image_name = await store_image(image) if image else None
+
+    previous = await db.posts.find_one_and_update({'uuid': post['uuid']},
+                                                   {'$unset': {'claimed_by': '', 'claim_expires': ''},
+                                                    '$set': {'moderated': is_approved,
+                                                             'timestamp_to_publish': timestamp_to_publish,
+                                                             'category_ids': category_ids,
+                                                             'title': title,
+                                                             'text': text,
+                                                             'excerpt': make_excerpt(text),
+                                                             'source': source,
+                                                             'likes': likes,
+                                                             'views': views,
+                                                             'publication_time': publication_time,
+                                                             'tags': tags
+
+                                                             } | ({'image_name': (
+                                                       image_name),
+                                                                  } if image else {})},
+                                                   projection={'moderated': 1, 'author': 1, 'likes': 1, 'views': 1})
 
     if image:
-        image_uuid = f'{uuid.uuid4()}'
-        image.filename = f"{image_uuid}{content_types[image.content_type]}"
-        contents = await image.read()
-
-        with open(f"{IMAGEDIR}{image.filename}", "wb") as f:
-            f.write(contents)
-
-    await db.posts.update_one({'uuid': post['uuid']},
-                              {'$set': {'moderated': is_approved,
-                                        'timestamp_to_publish': timestamp_to_publish,
-                                        'category_ids': category_ids,
-                                        'title': title,
-                                        'text': text,
-                                        'source': source,
-                                        'likes': likes,
-                                        'views': views,
-                                        'publication_time': publication_time,
-                                        'tags': tags
-
-                                        } | ({'image_name': (
-                                  image.filename),
-                                             } if image else {})})
+        await release_image(post.get('image_name'))
+    if previous:
+        await moderation.adjust(int(bool(previous.get('moderated'))) - int(is_approved))
+        author_stats.bump(previous.get('author'),
+                          posts=int(is_approved) - int(bool(previous.get('moderated'))),
+                          likes=likes - (previous.get('likes') or 0),
+                          views=views - (previous.get('views') or 0))
+    trending.touch(post_uuid)
+    post_cache.invalidate(post_uuid)
+    facet_cache.clear()
+    feed_cache.clear()
+    suggest.add_post({'uuid': post_uuid, 'title': title, 'tags': tags, 'moderated': is_approved,
+                      'timestamp_to_publish': timestamp_to_publish})
 
     return await posts_get(post_uuid, token)
 
@@ -401,9 +673,13 @@ async def comment_post(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
 
     data = {'uuid': f'{uuid.uuid4()}', 'post_uuid': post_uuid, 'user_uuid': current_user['uuid'], 'text': comment,
-            'liked_by': []}
+            'liked_by': [], 'likes': 0}
 
     await db.comments.insert_one(data)
+    trending.touch(post_uuid)
+    post_cache.invalidate(post_uuid)
+    notify(post.get('author'), current_user, 'notify_new_comment', f"Новый комментарий к публикации «{post['title']}»",
+           post_uuid)
 
     return CommentModel(
         uuid=data['uuid'],
@@ -418,30 +694,41 @@ async def comment_post(
     )
 
 
-async def get_comment(comment_uuid: str, current_user_uuid: str | None, level: int = 0) -> CommentModel:
-    replies = [await get_comment(x) async for x in db.comments.find({'post_uuid': comment_uuid})] if level == 0 else []
-    comment = await db.comments.find_one({'uuid': comment_uuid})
+def render_comment(comment: dict, author: dict | None, current_user_uuid: str | None,
+                   replies: typing.List[CommentModel]) -> CommentModel:
+    liked_by = comment.get('liked_by') or []
+    return CommentModel(uuid=comment['uuid'], post_uuid=comment['post_uuid'], author=UserModel.parse_obj(author),
+                        text=comment["text"], time=comment["_id"].generation_time.timestamp(),
+                        likes=comment.get('likes', len(liked_by)),
+                        is_liked=False if not current_user_uuid else current_user_uuid in liked_by,
+                        reply=replies, liked_by=liked_by)
 
-    return CommentModel(uuid=comment['uuid'], post_uuid=comment['post_uuid'], author=UserModel.parse_obj(
-        await db.users.find_one({'uuid': comment['user_uuid']})),
-                        text=comment["text"], time=comment["_id"].generation_time.timestamp(), likes=0,
-                        is_liked=False if not current_user_uuid else current_user_uuid in comment['liked_by'],
-                        reply=replies, liked_by=comment['liked_by'])
 
+async def get_comment(comment_uuid: str, current_user_uuid: str | None, level: int = 0,
+                      comment: dict | None = None) -> CommentModel:
+    replies = [await get_comment(x['uuid'], current_user_uuid, level + 1, x)
+               async for x in db.comments.find({'post_uuid': comment_uuid})] if level == 0 else []
+    comment = comment or await db.comments.find_one({'uuid': comment_uuid})
 
-@app.post("/post/like_comment", response_description="Like specific post", response_model=PostModel)
-async def like_post(current_user=Depends(get_current_user), comment_id: CommentUUID = Body()) -> CommentModel:
-    comment = await db.comments.find_one({'uuid': comment_id.comment_uuid})
-    if not comment:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
+    return render_comment(comment, await load_user(comment['user_uuid']), current_user_uuid, replies)
 
-    is_liked = current_user['uuid'] in comment['liked_by']
 
-    await db.comments.update_one({'uuid': comment_id.comment_uuid}, {
-        ('$pull' if is_liked else '$pull'): {f'liked_by': current_user['uuid']}
-    })
+@app.post("/post/like_comment", response_description="Like specific comment", response_model=CommentModel)
+async def like_comment(current_user=Depends(get_current_user), comment_id: CommentUUID = Body()) -> CommentModel:
+    liked_by = {'$ifNull': ['$liked_by', []]}
+    is_liked = {'$in': [current_user['uuid'], liked_by]}
 
-    return await get_comment(comment_id.comment_uuid, current_user['uuid'])
+    comment = await db.comments.find_one_and_update({'uuid': comment_id.comment_uuid}, [{'$set': {
+        'liked_by': {'$cond': [is_liked,
+                               {'$filter': {'input': liked_by, 'cond': {'$ne': ['$$this', current_user['uuid']]}}},
+                               {'$concatArrays': [liked_by, [current_user['uuid']]]}]},
+        'likes': {'$add': [{'$ifNull': ['$likes', {'$size': liked_by}]}, {'$cond': [is_liked, -1, 1]}]},
+    }}], return_document=ReturnDocument.AFTER)
+
+    if not comment:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Comment not found")
+
+    return await get_comment(comment['uuid'], current_user['uuid'], comment=comment)
 
 
 @app.get("/post/get_comments", response_description="Get comments", response_model=typing.List[CommentModel])
@@ -453,26 +740,40 @@ async def get_comments(
     current_user = await get_current_user(token) if token else {}
 
     async for comment in db.comments.find({'post_uuid': post_uuid}):
-        comments.append(await get_comment(comment['uuid'], current_user.get('uuid')))
+        comments.append(await get_comment(comment['uuid'], current_user.get('uuid'), comment=comment))
 
     return comments
 
 
-@app.get("/post/get", response_description="Get post by uuid")
-async def posts_get(
-        post_uuid: str,
-        token: str | None = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))
-):
-    post = await db.posts.find_one({'uuid': post_uuid})
-    current_user = await get_current_user(token) if token else None
+async def load_user(user_uuid: str) -> dict | None:
+    return await user_cache.load(user_uuid, lambda: db.users.find_one({'uuid': user_uuid}))
 
-    if not post:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
 
+async def load_post_bundle(post_uuid: str) -> dict | None:
+    async def fetch():
+        post = await db.posts.find_one({'uuid': post_uuid})
+        if not post:
+            return None
+
+        author, comments = await asyncio.gather(
+            load_user(post.get('author') or DEFAULT_AUTHOR_UUID),
+            db.comments.count_documents({'post_uuid': post_uuid})
+        )
+        return {'post': post, 'author': author, 'comments': comments}
+
+    return await post_cache.load(post_uuid, fetch)
+
+
+def post_projection(current_user: dict | None) -> dict:
+    return {'uuid': 1, 'author': 1, 'category_ids': 1, 'title': 1, 'text': 1, 'comments_disabled': 1, 'source': 1,
+            'image_name': 1, 'moderated': 1, 'likes': 1, 'views': 1, 'publication_time': 1, 'tags': 1} \
+        | ({f'liked_by.{current_user["uuid"]}': 1} if current_user else {})
+
+
+def render_post(post: dict, author: dict | None, comments: int, current_user: dict | None) -> PostModel:
     return PostModel(
         uuid=post['uuid'],
-        author=UserModel.parse_obj(
-            await db.users.find_one({'uuid': post.get('author') or 'ae4a4f7c-86a4-4ad6-a70b-9b1b7537a201'})),
+        author=UserModel.parse_obj(author),
         category_ids=post.get('category_ids') or [],
         title=post['title'],
         text=post['text'],
@@ -483,12 +784,26 @@ async def posts_get(
         likes=post['likes'],
         views=post['views'],
         is_liked=current_user and post.get('liked_by', {}).get(current_user['uuid']) or False,
-        comments=await db.comments.count_documents({'post_uuid': post['uuid']}),
+        comments=comments,
         publication_time=post['publication_time'],
         tags=post.get('tags') or []
     )
 
 
+@app.get("/post/get", response_description="Get post by uuid")
+async def posts_get(
+        post_uuid: str,
+        token: str | None = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))
+):
+    bundle = await load_post_bundle(post_uuid)
+    current_user = await get_current_user(token) if token else None
+
+    if not bundle:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
+
+    return render_post(bundle['post'], bundle['author'], bundle['comments'], current_user)
+
+
 @app.get("/post/query_not_moderated", response_description="Get not moderated feed posts")
 async def posts_feed_not_moderated(
         current_user=Depends(get_current_user),
@@ -524,26 +839,191 @@ async def posts_feed_not_moderated(
                                        ).sort([("publication_time", pymongo.DESCENDING)]).skip(offset).limit(count)]}
 
 
-@app.get("/post/query", response_description="Get feed posts")
+@app.get("/moderation/queue", response_description="Get a page of the moderation queue")
+async def moderation_queue(
+        current_user=Depends(get_current_user),
+        cursor: str | None = None,
+        category_id: int | None = None,
+        author: str | None = None,
+        count: int = Query(default=20, ge=1, le=100),
+        fields: str | None = None,
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    selected_fields = card_fields(fields)
+    posts = [x async for x in db.posts.find(moderation.queue_filter(current_user['uuid'], cursor, category_id, author),
+                                            card_projection(selected_fields, current_user)
+                                            | moderation.CURSOR_PROJECTION)
+             .sort(moderation.QUEUE_SORT).limit(count)]
+
+    return {"posts": await render_cards(posts, selected_fields, current_user),
+            "next_cursor": moderation.encode_cursor(posts[-1]) if len(posts) == count else None,
+            "backlog": await moderation.backlog()}
+
+
+@app.get("/moderation/count", response_description="Get the number of posts waiting for moderation")
+async def moderation_count(current_user=Depends(get_current_user)):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return {"backlog": await moderation.backlog(),
+            "claimed": await db.posts.count_documents({'moderated': False, 'claimed_by': current_user['uuid'],
+                                                       'claim_expires': {'$gte': time.time()}})}
+
+
+@app.post("/moderation/claim", response_description="Claim posts from the moderation queue")
+async def moderation_claim(
+        current_user=Depends(get_current_user),
+        count: int = Body(default=10, embed=True, ge=1, le=moderation.MAX_CLAIM),
+        post_uuid: str | None = Body(default=None, embed=True),
+        fields: str | None = Body(default=None, embed=True),
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    selected_fields = card_fields(fields)
+    posts = await moderation.claim(current_user['uuid'], count, card_projection(selected_fields, current_user),
+                                   post_uuid)
+    if post_uuid and not posts:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Post is already claimed or moderated")
+
+    return {"posts": await render_cards(posts, selected_fields, current_user),
+            "claim_expires": posts[0]['claim_expires'] if posts else None}
+
+
+@app.post("/moderation/release", response_description="Release claimed posts back to the moderation queue")
+async def moderation_release(
+        current_user=Depends(get_current_user),
+        post_uuid: str | None = Body(default=None, embed=True),
+):
+    if not current_user['permissions'] & Permissions.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
+
+    return {"released": await moderation.release(current_user['uuid'], post_uuid)}
+
+
+CARD_PROJECTION = {
+    'uuid': ['uuid'],
+    'author': ['author'],
+    'category_ids': ['category_ids'],
+    'tags': ['tags'],
+    'comments_disabled': ['comments_disabled'],
+    'title': ['title'],
+    'excerpt': ['excerpt'],
+    'image_name': ['image_name'],
+    'moderated': ['moderated'],
+    'likes': ['likes'],
+    'views': ['views'],
+    'is_liked': [],
+    'comments': [],
+    'publication_time': ['publication_time'],
+}
+
+
+def card_fields(fields: str | None) -> typing.Set[str]:
+    if not fields:
+        return set(CARD_PROJECTION)
+    return {x.strip() for x in fields.split(',') if x.strip() in CARD_PROJECTION} | {'uuid'}
+
+
+def card_projection(fields: typing.Set[str], current_user: dict | None) -> dict:
+    projection = {'_id': 0} | {x: 1 for field in fields for x in CARD_PROJECTION[field]}
+    if 'is_liked' in fields and current_user:
+        projection[f'liked_by.{current_user["uuid"]}'] = 1
+    return projection
+
+
+async def render_cards(posts: typing.List[dict], fields: typing.Set[str], current_user: dict | None) -> typing.List[dict]:
+    authors = {}
+    if 'author' in fields:
+        author_uuids = list({x.get('author') or DEFAULT_AUTHOR_UUID for x in posts})
+        async for author in db.users.find({'uuid': {'$in': author_uuids}},
+                                          {'_id': 0, 'uuid': 1, 'username': 1, 'name': 1, 'surname': 1,
+                                           'image_name': 1}):
+            authors[author['uuid']] = AuthorCardModel(**author)
+
+    comments = {}
+    if 'comments' in fields and posts:
+        async for x in db.comments.aggregate([
+            {'$match': {'post_uuid': {'$in': [post['uuid'] for post in posts]}}},
+            {'$group': {'_id': '$post_uuid', 'count': {'$sum': 1}}}
+        ]):
+            comments[x['_id']] = x['count']
+
+    return [
+        PostCardModel(
+            uuid=x['uuid'],
+            author=authors.get(x.get('author') or DEFAULT_AUTHOR_UUID),
+            category_ids=x.get('category_ids') or [],
+            tags=x.get('tags') or [],
+            comments_disabled=x.get('comments_disabled') or False,
+            title=x.get('title') or '',
+            excerpt=x.get('excerpt') or '',
+            image_name=x.get('image_name'),
+            moderated=x.get('moderated') or False,
+            likes=x.get('likes') or 0,
+            views=x.get('views') or 0,
+            is_liked=bool(current_user and x.get('liked_by', {}).get(current_user['uuid'])),
+            comments=comments.get(x['uuid'], 0),
+            publication_time=x.get('publication_time') or 0,
+        ).dict(include=fields)
+        for x in posts
+    ]
+
+
+async def backfill_excerpts(batch_size: int = 500):
+    while True:
+        posts = [x async for x in db.posts.find({'excerpt': {'$exists': False}}, {'uuid': 1, 'text': 1}).limit(batch_size)]
+        if not posts:
+            return
+
+        await db.posts.bulk_write([
+            pymongo.UpdateOne({'_id': x['_id']}, {'$set': {'excerpt': make_excerpt(x.get('text'))}}) for x in posts
+        ], ordered=False)
+        await asyncio.sleep(0.1)
+
+
+@app.get("/post/query", response_description="Get feed posts",
+         dependencies=[Depends(admission.limit('search', when=lambda request: 'search' in request.query_params))])
 async def posts_feed(
         search: str | None = None,
         category_id: int | None = None,
         author: str | None = None,
         offset: int | None = 0,
         count: int | None = 20,
+        view: str | None = None,
+        fields: str | None = None,
         token: str = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))
 ):
     current_user = await get_current_user(token) if token else None
 
-    req = db.posts.find({'moderated': True, 'timestamp_to_publish': {'$lte': int(time.time()*1000)}}
-                                       | ({'$text': {'$search': search}} if search else {})
-                                       | ({'category_ids': {'$elemMatch': {'$eq': category_id}}} if category_id else {})
-                                       | ({'author': author} if author else {})
-                                       )
+    if current_user or search:
+        return await feed_page(search, category_id, author, offset, count, view, fields, current_user)
+
+    return await feed_cache.load((category_id, author, offset, count, view, fields),
+                                 lambda: feed_page(None, category_id, author, offset, count, view, fields, None))
+
+
+async def feed_page(search: str | None, category_id: int | None, author: str | None, offset: int, count: int,
+                    view: str | None, fields: str | None, current_user: dict | None) -> dict:
+    query = ({'moderated': True, 'timestamp_to_publish': {'$lte': int(time.time()*1000)}}
+             | ({'$text': {'$search': search}} if search else {})
+             | ({'category_ids': {'$elemMatch': {'$eq': category_id}}} if category_id else {})
+             | ({'author': author} if author else {}))
+
+    is_card = view == 'card' or fields is not None
+    selected_fields = card_fields(fields) if is_card else None
+
+    req = db.posts.find(query, card_projection(selected_fields, current_user) if is_card else None)
 
     if not search or search[0] == '#':
         req = req.sort([("publication_time", pymongo.DESCENDING)])
 
+    if is_card:
+        return {"posts": await render_cards([x async for x in req.skip(offset).limit(count)], selected_fields,
+                                            current_user)}
+
     return {"posts": [
         PostModel(
             uuid=x['uuid'],
@@ -566,44 +1046,144 @@ async def posts_feed(
         ) async for x in req.skip(offset).limit(count)]}
 
 
+async def compute_facets(author: str | None, search: str | None, tags_limit: int) -> FacetsModel:
+    query = (published_filter()
+             | ({'$text': {'$search': search}} if search else {})
+             | ({'author': author} if author else {}))
+
+    result = await db.posts.aggregate([
+        {'$match': query},
+        {'$project': {'category_ids': 1, 'tags': 1}},
+        {'$facet': {
+            'total': [{'$count': 'count'}],
+            'categories': [
+                {'$unwind': '$category_ids'},
+                {'$group': {'_id': '$category_ids', 'count': {'$sum': 1}}},
+                {'$sort': {'_id': 1}}
+            ],
+            'tags': [
+                {'$unwind': '$tags'},
+                {'$match': {'tags': {'$ne': ''}}},
+                {'$group': {'_id': '$tags', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': tags_limit}
+            ]
+        }}
+    ]).to_list(length=1)
+
+    facets = result[0] if result else {}
+    return FacetsModel(
+        total=facets['total'][0]['count'] if facets.get('total') else 0,
+        categories=[{'category_id': x['_id'], 'count': x['count']} for x in facets.get('categories', [])],
+        tags=[{'tag': x['_id'], 'count': x['count']} for x in facets.get('tags', [])]
+    )
+
+
+@app.get("/post/facets", response_description="Get category and tag counts", response_model=FacetsModel,
+         dependencies=[Depends(admission.limit('search', when=lambda request: 'search' in request.query_params))])
+async def posts_facets(
+        author: str | None = None,
+        search: str | None = None,
+        tags_limit: int = 50,
+):
+    tags_limit = max(1, min(tags_limit, 200))
+    return await facet_cache.load((author, search, tags_limit), lambda: compute_facets(author, search, tags_limit))
+
+
+@app.get("/search/suggest", response_description="Autocomplete titles, tags and usernames",
+         response_model=typing.List[SuggestionModel])
+async def search_suggest(
+        q: str,
+        limit: int = 10,
+        kinds: str | None = None,
+):
+    selected_kinds = {x.strip() for x in kinds.split(',')} & set(suggest.KINDS) if kinds else suggest.KINDS
+    return [SuggestionModel(kind=kind, value=value, uuid=ref)
+            for kind, value, ref in suggest.index.lookup(q, max(1, min(limit, 50)), selected_kinds)]
+
+
+@app.get("/post/trending", response_description="Get trending posts")
+async def posts_trending(
+        offset: int | None = 0,
+        count: int | None = 20,
+        view: str | None = None,
+        fields: str | None = None,
+        token: str = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))
+):
+    current_user = await get_current_user(token) if token else None
+
+    is_card = view == 'card' or fields is not None
+    selected_fields = card_fields(fields) if is_card else None
+    projection = card_projection(selected_fields, current_user) | {'uuid': 1} if is_card else None
+
+    post_uuids = trending.page(offset, count)
+    if post_uuids is None:
+        posts = [x async for x in db.posts.find(published_filter() | {'trend_score': {'$gt': 0}}, projection)
+                 .sort([('trend_score', pymongo.DESCENDING)]).skip(offset).limit(count)]
+    else:
+        found = {x['uuid']: x async for x in db.posts.find({'uuid': {'$in': post_uuids}} | published_filter(),
+                                                           projection)}
+        posts = [found[x] for x in post_uuids if x in found]
+
+    if is_card:
+        return {"posts": await render_cards(posts, selected_fields, current_user)}
+
+    authors = {x['uuid']: x async for x in db.users.find(
+        {'uuid': {'$in': list({x.get('author') or DEFAULT_AUTHOR_UUID for x in posts})}})}
+    comments = await comment_counts([x['uuid'] for x in posts])
+
+    return {"posts": [
+        render_post(x, authors.get(x.get('author') or DEFAULT_AUTHOR_UUID), comments.get(x['uuid'], 0), current_user)
+        for x in posts
+    ]}
+
+
 @app.post("/post/like", response_description="Like specific post", response_model=PostModel)
 async def like_post(current_user=Depends(get_current_user), post_id: PostUUID = Body()):
-    post = await db.posts.find_one({'uuid': post_id.post_uuid})
+    was_liked = {'$eq': [f'$liked_by.{current_user["uuid"]}', True]}
+
+    post, comments = await asyncio.gather(
+        db.posts.find_one_and_update({'uuid': post_id.post_uuid}, [{'$set': {
+            f'liked_by.{current_user["uuid"]}': {'$not': [was_liked]},
+            'likes': {'$add': [{'$ifNull': ['$likes', 0]}, {'$cond': [was_liked, -1, 1]}]},
+        }}], projection=post_projection(current_user), return_document=ReturnDocument.AFTER),
+        db.comments.count_documents({'post_uuid': post_id.post_uuid})
+    )
+
     if not post:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
 
-    is_liked = post.get('liked_by', {}).get(current_user['uuid']) or False
+    is_liked = post['liked_by'][current_user['uuid']]
 
-    diff = -1 if is_liked else 1
+    author_stats.bump(post.get('author'), likes=1 if is_liked else -1)
+    trending.touch(post['uuid'])
+    post_cache.invalidate(post['uuid'])
 
-    await db.posts.update_one({'uuid': post_id.post_uuid}, {
-        '$set': {f'liked_by.{current_user["uuid"]}': not is_liked},
-        '$inc': {'likes': diff}
-    })
+    if is_liked:
+        notify(post.get('author'), current_user, 'notify_new_like', f"Новая оценка публикации «{post['title']}»",
+               post['uuid'])
 
-    return PostModel(
-        uuid=post['uuid'],
-        author=UserModel.parse_obj(
-            await db.users.find_one({'uuid': post.get('author') or 'ae4a4f7c-86a4-4ad6-a70b-9b1b7537a201'})),
-        category_ids=post.get('category_ids') or [],
-        title=post['title'],
-        text=post['text'],
-        comments_disabled=post.get('comments_disabled') or False,
-        source=post['source'],
-        image_name=(post['image_name']),
-        moderated=post['moderated'],
-        likes=post['likes'] + diff,
-        views=post['views'],
-        is_liked=not is_liked,
-        comments=await db.comments.count_documents({'post_uuid': post['uuid']}),
-        publication_time=post['publication_time'],
-        tags=post.get('tags') or []
-    )
+    return render_post(post, await load_user(post.get('author') or DEFAULT_AUTHOR_UUID), comments, current_user)
 
 
 @app.delete("/post/delete", response_description="Delete specific post", response_model=dict)
 async def like_post(current_user=Depends(get_current_user), post_id: PostUUID = Body()):
-    await db.posts.delete_one({'uuid': post_id.post_uuid})
+    post = await db.posts.find_one_and_delete({'uuid': post_id.post_uuid})
+    post_cache.invalidate(post_id.post_uuid)
+
+    if post:
+        await db.deleted_posts.insert_one({'uuid': post['uuid'], 'image_name': post.get('image_name'),
+                                           'deleted_at': int(time.time())})
+        await moderation.adjust(-int(not post.get('moderated')))
+        facet_cache.clear()
+        feed_cache.clear()
+        suggest.remove_post(post)
+        trending.discard(post['uuid'])
+        author_stats.bump(post.get('author'),
+                          posts=-int(bool(post.get('moderated'))),
+                          likes=-(post.get('likes') or 0),
+                          views=-(post.get('views') or 0))
+
     return {"ok": True}
 
 
@@ -614,6 +1194,7 @@ async def manage_comments(current_user=Depends(get_current_user), post_id: str =
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You're not the admin")
 
     await db.posts.update_one({'uuid': post_id}, {'$set': {'comments_enabled': enable_comments}})
+    post_cache.invalidate(post_id)
     return {"ok": True}
 
 
@@ -621,40 +1202,27 @@ async def manage_comments(current_user=Depends(get_current_user), post_id: str =
 async def view_post(token: str = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False)), post_id: PostUUID = Body()):
     current_user = await get_current_user(token) if token and token != 'null' else None
 
-    post = await db.posts.find_one({'uuid': post_id.post_uuid})
+    bundle = await load_post_bundle(post_id.post_uuid)
 
-    if not post:
+    if not bundle:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Post not found")
 
+    post = bundle['post']
+
     if current_user:
-        is_liked = post.get('liked_by', {}).get(current_user['uuid']) or False,
-        is_viewed = current_user['uuid'] in (post.get('viewed_by') or [])
-        if not is_viewed:
-            await db.posts.update_one({'uuid': post_id.post_uuid}, {
-                '$push': {'viewed_by': current_user['uuid']},
-                '$inc': {'views': 1}
-            })
+        result = await db.posts.update_one({'uuid': post_id.post_uuid, 'viewed_by': {'$ne': current_user['uuid']}}, {
+            '$push': {'viewed_by': current_user['uuid']},
+            '$inc': {'views': 1}
+        })
+        is_viewed = not result.modified_count
     else:
         await db.posts.update_one({'uuid': post_id.post_uuid}, {
             '$inc': {'views': 1}
         })
-        is_liked = False
+        is_viewed = False
 
-    return PostModel(
-        uuid=post['uuid'],
-        author=UserModel.parse_obj(
-            await db.users.find_one({'uuid': post.get('author') or 'ae4a4f7c-86a4-4ad6-a70b-9b1b7537a201'})),
-        category_ids=post.get('category_ids') or [],
-        title=post['title'],
-        text=post['text'],
-        comments_disabled=post.get('comments_disabled') or False,
-        source=post['source'],
-        image_name=(post['image_name']),
-        moderated=post['moderated'],
-        likes=post['likes'],
-        views=post['views'],
-        is_liked=not is_liked,
-        comments=await db.comments.count_documents({'post_uuid': post['uuid']}),
-        publication_time=post['publication_time'],
-        tags=post.get('tags') or []
-    )
+    if not is_viewed:
+        author_stats.bump(post.get('author'), views=1)
+        trending.touch(post['uuid'])
+
+    return render_post(post, bundle['author'], bundle['comments'], current_user)
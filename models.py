@@ -23,6 +23,14 @@ class PyObjectId(ObjectId):
         field_schema.update(type="string")
 
 
+class AuthorStats(BaseModel):
+    posts: int = Field(0)
+    likes: int = Field(0)
+    views: int = Field(0)
+    followers: int = Field(0)
+    following: int = Field(0)
+
+
 class UserModel(BaseModel):
     uuid: str = Field(...)
     email: str = Field(...)
@@ -53,6 +61,8 @@ class UserModel(BaseModel):
     about_text: str | None = Field(default=None)
     screen_name: str | None = Field(default=None)
 
+    stats: AuthorStats = Field(default_factory=AuthorStats)
+
     def __init__(self, *args, **kwargs):
         if 'username' not in kwargs.keys():
             kwargs['username'] = f"{kwargs.get('name') or 'Некто'} {kwargs.get('surname') or 'Некто'}"
@@ -258,6 +268,99 @@ class PostModel(BaseModel):
         }
 
 
+class AuthorCardModel(BaseModel):
+    uuid: str = Field(...)
+    username: str = Field(...)
+    avatar: str | None = Field(default=None)
+
+    def __init__(self, *args, **kwargs):
+        if not kwargs.get('username'):
+            kwargs['username'] = f"{kwargs.get('name') or 'Некто'} {kwargs.get('surname') or 'Некто'}"
+
+        kwargs['avatar'] = 'https://api.obrazovanie.press/images/' + kwargs.get('image_name') if kwargs.get('image_name') else 'https://www.ktoeos.org/wp-content/uploads/2021/11/default-avatar.png'
+
+        super().__init__(**kwargs)
+
+
+class PostCardModel(BaseModel):
+    uuid: str = Field(...)
+    author: AuthorCardModel | None = Field(default=None)
+    category_ids: List[int] = Field(default=[])
+    tags: typing.List[str] = Field(default=[])
+    comments_disabled: bool = Field(default=False)
+
+    title: str = Field(default='')
+    excerpt: str = Field(default='')
+    image_name: Optional[str] = Field(default=None)
+    moderated: bool = Field(False)
+    likes: int = Field(0)
+    views: int = Field(0)
+    is_liked: bool = Field(False)
+    comments: int = Field(0)
+    publication_time: int = Field(0)
+
+    class Config:
+        allow_population_by_field_name = True
+        schema_extra = {
+            "example": {
+                "uuid": "b45580b6-0e71-453a-bb9b-88cf1004f3dd",
+                "author": {
+                    "uuid": "ae4a4f7c-86a4-4ad6-a70b-9b1b7537a201",
+                    "username": "Test Bot",
+                    "avatar": "https://www.ktoeos.org/wp-content/uploads/2021/11/default-avatar.png"
+                },
+                "category_ids": [1],
+                "title": "Раст топ!",
+                "excerpt": "Раст был признан лучшим языком программирования!",
+                "image_name": None,
+                "likes": 0,
+                "views": 0,
+                "is_liked": False,
+                "comments": 0
+            }
+        }
+
+
+class CategoryFacet(BaseModel):
+    category_id: int = Field(...)
+    count: int = Field(...)
+
+
+class TagFacet(BaseModel):
+    tag: str = Field(...)
+    count: int = Field(...)
+
+
+class FacetsModel(BaseModel):
+    total: int = Field(0)
+    categories: List[CategoryFacet] = Field(default=[])
+    tags: List[TagFacet] = Field(default=[])
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "total": 3,
+                "categories": [{"category_id": 1, "count": 2}, {"category_id": 2, "count": 1}],
+                "tags": [{"tag": "раст", "count": 2}]
+            }
+        }
+
+
+class SuggestionModel(BaseModel):
+    kind: str = Field(...)
+    value: str = Field(...)
+    uuid: str | None = Field(default=None)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "kind": "title",
+                "value": "Раст топ!",
+                "uuid": "b45580b6-0e71-453a-bb9b-88cf1004f3dd"
+            }
+        }
+
+
 class CommentModel(BaseModel):
     uuid: str = Field(...)
     post_uuid: str = Field(...)
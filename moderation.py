@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+import typing
+
+import pymongo
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from starlette import status
+
+from mongo import db
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_ID = 'moderation_backlog'
+CLAIM_TTL = 15 * 60
+MAX_CLAIM = 50
+RECONCILE_INTERVAL = 10 * 60
+
+QUEUE_SORT = [('publication_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+
+CURSOR_PROJECTION = {'_id': 1, 'publication_time': 1}
+
+
+def encode_cursor(post: dict) -> str:
+    if not isinstance(post.get('publication_time'), int) or '_id' not in post:
+        raise ValueError(f"Cannot build a moderation cursor from post {post.get('uuid')}")
+    return f"{post['publication_time']}:{post['_id']}"
+
+
+def decode_cursor(cursor: str) -> typing.Tuple[int, ObjectId]:
+    publication_time, _, post_id = cursor.partition(':')
+    try:
+        return int(publication_time), ObjectId(post_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect cursor")
+
+
+def available(moderator_uuid: str) -> dict:
+    return {'$or': [{'claimed_by': None}, {'claimed_by': moderator_uuid}, {'claim_expires': {'$lt': time.time()}}]}
+
+
+def queue_filter(moderator_uuid: str, cursor: str | None = None, category_id: int | None = None,
+                 author: str | None = None) -> dict:
+    conditions = [available(moderator_uuid)]
+    if cursor:
+        publication_time, post_id = decode_cursor(cursor)
+        conditions.append({'$or': [{'publication_time': {'$lt': publication_time}},
+                                   {'publication_time': publication_time, '_id': {'$lt': post_id}}]})
+
+    return ({'moderated': False, '$and': conditions}
+            | ({'category_ids': {'$elemMatch': {'$eq': category_id}}} if category_id else {})
+            | ({'author': author} if author else {}))
+
+
+async def adjust(delta: int):
+    if delta:
+        await db.counters.update_one({'_id': BACKLOG_ID}, {'$inc': {'value': delta}}, upsert=True)
+
+
+async def reconcile() -> int:
+    count = await db.posts.count_documents({'moderated': False})
+    await db.counters.update_one({'_id': BACKLOG_ID}, {'$set': {'value': count, 'reconciled_at': time.time()}},
+                                 upsert=True)
+    return count
+
+
+async def backlog() -> int:
+    counter = await db.counters.find_one({'_id': BACKLOG_ID})
+    if counter is None:
+        return await reconcile()
+    return max(0, counter.get('value') or 0)
+
+
+async def run_reconciliation(interval: float = RECONCILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            logger.info('Moderation backlog reconciled: %s', await reconcile())
+        except Exception:
+            logger.exception('Moderation backlog reconciliation failed')
+
+
+async def claim(moderator_uuid: str, count: int, projection: dict, post_uuid: str | None = None,
+                ttl: float = CLAIM_TTL) -> typing.List[dict]:
+    claimed = []
+    claim_expires = time.time() + ttl
+
+    for _ in range(1 if post_uuid else min(count, MAX_CLAIM)):
+        post = await db.posts.find_one_and_update(
+            {'moderated': False, '_id': {'$nin': [x['_id'] for x in claimed]}} | available(moderator_uuid)
+            | ({'uuid': post_uuid} if post_uuid else {}),
+            {'$set': {'claimed_by': moderator_uuid, 'claim_expires': claim_expires}},
+            projection=projection | {'_id': 1, 'claim_expires': 1}, sort=QUEUE_SORT, return_document=ReturnDocument.AFTER)
+        if not post:
+            break
+        claimed.append(post)
+
+    return claimed
+
+
+async def release(moderator_uuid: str, post_uuid: str | None = None) -> int:
+    result = await db.posts.update_many({'claimed_by': moderator_uuid} | ({'uuid': post_uuid} if post_uuid else {}),
+                                        {'$unset': {'claimed_by': '', 'claim_expires': ''}})
+    return result.modified_count
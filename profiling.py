@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import typing
+import uuid
+
+from fastapi import HTTPException
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from auth import get_current_user
+
+MAX_DEPTH = 64
+MAX_STACKS = 20000
+STORED_PROFILES = 50
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+
+
+def current_task(loop: asyncio.AbstractEventLoop) -> asyncio.Task | None:
+    # asyncio.current_task() only works from the loop thread, the sampler reads the loop's running task directly
+    return asyncio.tasks._current_tasks.get(loop)
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float = 0.005, max_stacks: int = MAX_STACKS,
+                 loop: asyncio.AbstractEventLoop | None = None, tasks: typing.Set[asyncio.Task] | None = None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.loop = loop
+        self.tasks = tasks
+        self.counts: typing.Counter[str] = collections.Counter()
+        self.samples = 0
+        self.skipped = 0
+        self.started_at = 0.0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _sample(self):
+        task = current_task(self.loop) if self.tasks is not None else None
+        if self.tasks is not None and task not in self.tasks:
+            self.skipped += 1
+            return
+
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+
+        if not stack:
+            return
+
+        if self.tasks is not None and current_task(self.loop) is not task:
+            self.skipped += 1
+            return
+
+        folded = ';'.join(reversed(stack))
+        with self.lock:
+            if folded in self.counts or len(self.counts) < self.max_stacks:
+                self.counts[folded] += 1
+            else:
+                self.counts['[truncated]'] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def folded(self) -> str:
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.counts.most_common())
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.samples = 0
+            self.skipped = 0
+        self.started_at = time.time()
+
+
+owners: typing.Dict[asyncio.Task, StackSampler] = {}
+
+
+def track_children(loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    owner = owners.get(current_task(loop))
+    if owner:
+        owners[task] = owner
+        owner.tasks.add(task)
+    return task
+
+
+def install_task_factory(loop: asyncio.AbstractEventLoop) -> bool:
+    if loop.get_task_factory() is None:
+        loop.set_task_factory(track_children)
+    return loop.get_task_factory() is track_children
+
+
+class ProfileStore:
+    def __init__(self, size: int = STORED_PROFILES):
+        self.profiles: typing.OrderedDict[str, dict] = collections.OrderedDict()
+        self.size = size
+
+    def add(self, profile_id: str, profile: dict):
+        self.profiles[profile_id] = profile
+        while len(self.profiles) > self.size:
+            self.profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> dict | None:
+        return self.profiles.get(profile_id)
+
+    def list(self) -> typing.List[dict]:
+        return [{k: v for k, v in profile.items() if k != 'folded'} | {'id': profile_id}
+                for profile_id, profile in reversed(self.profiles.items())]
+
+
+profiles = ProfileStore()
+continuous: StackSampler | None = None
+
+
+def start_continuous(interval: float = 0.01) -> StackSampler:
+    global continuous
+    if continuous and continuous.running:
+        return continuous
+
+    continuous = StackSampler(threading.get_ident(), interval)
+    continuous.start()
+    return continuous
+
+
+def stop_continuous() -> StackSampler | None:
+    if continuous:
+        continuous.stop()
+    return continuous
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, is_admin: typing.Callable[[dict], bool], interval: float = 0.001):
+        self.app = app
+        self.is_admin = is_admin
+        self.interval = interval
+
+    @staticmethod
+    def requested(scope: Scope) -> bool:
+        headers = Headers(scope=scope)
+        return headers.get('x-profile') == '1' or QueryParams(scope.get('query_string', b'')).get('__profile') == '1'
+
+    async def authorized(self, scope: Scope) -> bool:
+        scheme, _, token = Headers(scope=scope).get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return False
+
+        try:
+            return bool(self.is_admin(await get_current_user(token)))
+        except HTTPException:
+            return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not self.requested(scope) or not await self.authorized(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f'{uuid.uuid4()}'
+
+        async def send_with_id(message: Message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message).append('X-Profile-Id', profile_id)
+            await send(message)
+
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        children = install_task_factory(loop)
+
+        sampler = StackSampler(threading.get_ident(), self.interval, loop=loop, tasks={task})
+        owners[task] = sampler
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            for x in sampler.tasks:
+                owners.pop(x, None)
+            profiles.add(profile_id, {
+                'path': scope['path'],
+                'method': scope['method'],
+                'started_at': sampler.started_at,
+                'duration': time.perf_counter() - started,
+                'samples': sampler.samples,
+                'skipped': sampler.skipped,
+                'scope': 'request' if children else 'request task only',
+                'folded': sampler.folded(),
+            })
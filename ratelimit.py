@@ -0,0 +1,172 @@
+import asyncio
+import math
+import time
+import typing
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request
+from jose import JWTError, jwt
+from starlette import status
+
+from auth import SECRET_KEY, ALGORITHM
+from tasks import task_queue
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.updated = time.monotonic()
+
+
+class RateLimiter:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.buckets: typing.OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def wait(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+            self.buckets.move_to_end(key)
+
+        if bucket.tokens >= 1:
+            return 0.0
+
+        return (1 - bucket.tokens) / rate
+
+    def take(self, key: str):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.tokens -= 1
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.task: asyncio.Task | None = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+class Budget(typing.NamedTuple):
+    rate: float
+    burst: int
+    concurrency: int | None = None
+
+
+ROUTE_BUDGETS = {
+    'signup': Budget(rate=5 / 60, burst=5, concurrency=4),
+    'login': Budget(rate=10 / 60, burst=10, concurrency=4),
+    'search': Budget(rate=1, burst=10, concurrency=16),
+    'upload': Budget(rate=10 / 60, burst=10, concurrency=4),
+}
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else 'unknown'
+
+
+def token_subject(request: Request) -> str | None:
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get('sub')
+    except JWTError:
+        return None
+
+
+class AdmissionController:
+    def __init__(self, limiter: RateLimiter, monitor: LoopMonitor, max_lag: float = 0.5,
+                 max_queue_depth: int = 8000, queue_depth: typing.Callable[[], int] = lambda: 0):
+        self.limiter = limiter
+        self.monitor = monitor
+        self.max_lag = max_lag
+        self.max_queue_depth = max_queue_depth
+        self.queue_depth = queue_depth
+        self.inflight: typing.Dict[str, int] = {}
+        self.counters: typing.Dict[str, typing.Dict[str, int]] = {}
+
+    def _count(self, route: str, name: str):
+        route_counters = self.counters.setdefault(route, {'allowed': 0, 'limited': 0, 'shed': 0})
+        route_counters[name] += 1
+
+    def overloaded(self) -> bool:
+        return self.monitor.lag > self.max_lag or self.queue_depth() > self.max_queue_depth
+
+    def limit(self, route: str, when: typing.Callable[[Request], bool] | None = None):
+        budget = ROUTE_BUDGETS[route]
+
+        async def dependency(request: Request):
+            if when and not when(request):
+                yield
+                return
+
+            keys = [f'{route}:ip:{client_ip(request)}']
+            subject = token_subject(request)
+            if subject:
+                keys.append(f'{route}:user:{subject}')
+
+            # tokens are only spent on admitted requests, so 429s and 503s do not drain the other buckets
+            retry_after = max(self.limiter.wait(key, budget.rate, budget.burst) for key in keys)
+            if retry_after:
+                self._count(route, 'limited')
+                raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests",
+                                    headers={'Retry-After': str(math.ceil(retry_after))})
+
+            if self.overloaded() or (budget.concurrency and self.inflight.get(route, 0) >= budget.concurrency):
+                self._count(route, 'shed')
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is busy",
+                                    headers={'Retry-After': '1'})
+
+            for key in keys:
+                self.limiter.take(key)
+            self._count(route, 'allowed')
+            self.inflight[route] = self.inflight.get(route, 0) + 1
+            try:
+                yield
+            finally:
+                self.inflight[route] -= 1
+
+        return dependency
+
+    def stats(self) -> dict:
+        return {
+            'routes': self.counters,
+            'inflight': self.inflight,
+            'loop_lag': self.monitor.lag,
+            'max_loop_lag': self.monitor.max_lag,
+            'tracked_keys': len(self.limiter.buckets),
+        }
+
+
+loop_monitor = LoopMonitor()
+admission = AdmissionController(RateLimiter(), loop_monitor,
+                                queue_depth=lambda: task_queue.queue.qsize() if task_queue.queue else 0)
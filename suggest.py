@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import logging
+import re
+import time
+import typing
+
+from mongo import db
+from utils import published_filter
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 200000
+MIN_WORD_LENGTH = 3
+REBUILD_INTERVAL = 60 * 60
+SCHEDULE_INTERVAL = 30
+
+KINDS = ('title', 'tag', 'user')
+
+_words_re = re.compile(r'[\w#]+')
+
+Entity = typing.Tuple[str, str, str | None]
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+
+def terms(kind: str, value: str) -> typing.Set[str]:
+    full = normalize(value)
+    if kind == 'tag':
+        return {full, full.lstrip('#')} - {''}
+
+    words = {word.lstrip('#') for word in _words_re.findall(full)}
+    return ({full} | {word for word in words if len(word) >= MIN_WORD_LENGTH}) - {''}
+
+
+class PrefixIndex:
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.keys: typing.List[typing.Tuple[str, Entity]] = []
+        self.refs: typing.Dict[Entity, int] = {}
+        self.dropped = 0
+
+    def _insert(self, entity: Entity):
+        keys = [(term, entity) for term in terms(entity[0], entity[1])]
+        if len(self.keys) + len(keys) > self.max_entries:
+            self.dropped += 1
+            return False
+
+        for key in keys:
+            bisect.insort(self.keys, key)
+        return True
+
+    def _delete(self, entity: Entity):
+        for term in terms(entity[0], entity[1]):
+            i = bisect.bisect_left(self.keys, (term, entity))
+            if i < len(self.keys) and self.keys[i] == (term, entity):
+                del self.keys[i]
+
+    def add(self, kind: str, value: str | None, ref: str | None = None):
+        if not value or not value.strip():
+            return
+
+        entity = (kind, value.strip(), ref)
+        if entity in self.refs:
+            self.refs[entity] += 1
+        elif self._insert(entity):
+            self.refs[entity] = 1
+
+    def remove(self, kind: str, value: str | None, ref: str | None = None):
+        if not value or not value.strip():
+            return
+
+        entity = (kind, value.strip(), ref)
+        if entity not in self.refs:
+            return
+
+        self.refs[entity] -= 1
+        if self.refs[entity] <= 0:
+            del self.refs[entity]
+            self._delete(entity)
+
+    def replace(self, entities: typing.Iterable[Entity]):
+        refs: typing.Dict[Entity, int] = {}
+        keys = []
+        for kind, value, ref in entities:
+            if not value or not value.strip():
+                continue
+
+            entity = (kind, value.strip(), ref)
+            if entity not in refs:
+                entity_keys = [(term, entity) for term in terms(kind, entity[1])]
+                if len(keys) + len(entity_keys) > self.max_entries:
+                    self.dropped += 1
+                    continue
+                keys.extend(entity_keys)
+            refs[entity] = refs.get(entity, 0) + 1
+
+        keys.sort()
+        self.keys, self.refs = keys, refs
+
+    def lookup(self, prefix: str, limit: int = 10, kinds: typing.Collection[str] = KINDS,
+               scan_limit: int = 500) -> typing.List[Entity]:
+        prefix = normalize(prefix).lstrip('#') or normalize(prefix)
+        if not prefix:
+            return []
+
+        found: typing.Dict[Entity, bool] = {}
+        i = bisect.bisect_left(self.keys, (prefix,))
+        end = min(len(self.keys), i + scan_limit)
+
+        while i < end and self.keys[i][0].startswith(prefix):
+            term, entity = self.keys[i]
+            if entity[0] in kinds:
+                found[entity] = found.get(entity, False) or term == prefix
+            i += 1
+
+        ranked = sorted(found, key=lambda x: (not found[x], -self.refs.get(x, 0), len(x[1]), x[1]))
+        return ranked[:limit]
+
+
+index = PrefixIndex()
+indexed: typing.Dict[str, typing.Tuple[str | None, typing.Tuple[str, ...]]] = {}
+scheduled: typing.Dict[str, dict] = {}
+
+
+def user_names(user: dict) -> typing.List[str]:
+    if user.get('hide_profile') or user.get('is_banned'):
+        return []
+
+    username = user.get('username') or f"{user.get('name') or 'Некто'} {user.get('surname') or 'Некто'}"
+    return [x for x in {username, user.get('screen_name')} if x]
+
+
+def is_published(post: dict) -> bool:
+    return bool(post.get('moderated')) and (post.get('timestamp_to_publish') or 0) <= int(time.time() * 1000)
+
+
+def post_entities(post_uuid: str, title: str | None, tags: typing.Iterable[str]) -> typing.List[Entity]:
+    return [('title', title, post_uuid)] + [('tag', tag, None) for tag in tags]
+
+
+def index_post(post: dict):
+    title, tags = post.get('title'), tuple(post.get('tags') or [])
+    for entity in post_entities(post['uuid'], title, tags):
+        index.add(*entity)
+    indexed[post['uuid']] = (title, tags)
+
+
+def add_post(post: dict):
+    remove_post(post)
+    if not post.get('moderated'):
+        return
+
+    if is_published(post):
+        index_post(post)
+    else:
+        scheduled[post['uuid']] = {k: post.get(k) for k in ('uuid', 'title', 'tags', 'timestamp_to_publish')}
+
+
+def remove_post(post: dict):
+    scheduled.pop(post['uuid'], None)
+    if post['uuid'] not in indexed:
+        return
+
+    title, tags = indexed.pop(post['uuid'])
+    for entity in post_entities(post['uuid'], title, tags):
+        index.remove(*entity)
+
+
+def publish_scheduled() -> int:
+    due = [post for post in scheduled.values() if is_published(post | {'moderated': True})]
+    for post in due:
+        del scheduled[post['uuid']]
+        index_post(post)
+    return len(due)
+
+
+def add_user(user: dict):
+    for name in user_names(user):
+        index.add('user', name, user['uuid'])
+
+
+def remove_user(user: dict):
+    for name in user_names(user):
+        index.remove('user', name, user['uuid'])
+
+
+async def rebuild():
+    global indexed, scheduled
+    entities: typing.List[Entity] = []
+    posts = {}
+    upcoming = {}
+
+    async for post in db.posts.find(published_filter(), {'uuid': 1, 'title': 1, 'tags': 1}):
+        posts[post['uuid']] = (post.get('title'), tuple(post.get('tags') or []))
+        entities.extend(post_entities(post['uuid'], *posts[post['uuid']]))
+
+    async for post in db.posts.find({'moderated': True, 'timestamp_to_publish': {'$gt': int(time.time() * 1000)}},
+                                    {'_id': 0, 'uuid': 1, 'title': 1, 'tags': 1, 'timestamp_to_publish': 1}):
+        upcoming[post['uuid']] = post
+
+    async for user in db.users.find({'is_banned': {'$ne': True}, 'hide_profile': {'$ne': True}},
+                                    {'uuid': 1, 'username': 1, 'name': 1, 'surname': 1, 'screen_name': 1}):
+        entities.extend(('user', name, user['uuid']) for name in user_names(user))
+
+    index.replace(entities)
+    indexed, scheduled = posts, upcoming
+    return len(index.keys)
+
+
+async def run_rebuilds(interval: float = REBUILD_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await rebuild()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Suggest index rebuild failed')
+
+
+async def run_scheduled(interval: float = SCHEDULE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        published = publish_scheduled()
+        if published:
+            logger.info('Added %d scheduled posts to the suggest index', published)
+
+
+def stats() -> dict:
+    return {'keys': len(index.keys), 'entities': len(index.refs), 'dropped': index.dropped, 'posts': len(indexed),
+            'scheduled': len(scheduled)}
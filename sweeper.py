@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import time
+import typing
+import uuid
+
+from images import IMAGEDIR, release_image, image_path
+from mongo import db
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = 60 * 60
+IMAGE_GRACE_PERIOD = 24 * 60 * 60
+
+
+class Sweeper:
+    def __init__(self, batch_size: int = 200, pause: float = 0.05, grace_period: float = IMAGE_GRACE_PERIOD):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.grace_period = grace_period
+        self.lock = asyncio.Lock()
+        self.last_report: dict | None = None
+
+    async def _throttle(self):
+        await asyncio.sleep(self.pause)
+
+    async def _delete_comments(self, parent_uuid: str, dry_run: bool) -> int:
+        removed = 0
+        parents = [parent_uuid]
+        seen = set()
+
+        while parents:
+            parent = parents.pop()
+            skip = 0
+            while True:
+                comments = [x async for x in db.comments.find({'post_uuid': parent}, {'uuid': 1})
+                            .sort('_id', 1).skip(skip).limit(self.batch_size)]
+                if not comments:
+                    break
+
+                parents.extend(x['uuid'] for x in comments if x['uuid'] not in seen)
+                seen.update(x['uuid'] for x in comments)
+                removed += len(comments)
+
+                if dry_run:
+                    skip += len(comments)
+                else:
+                    await db.comments.delete_many({'_id': {'$in': [x['_id'] for x in comments]}})
+                await self._throttle()
+
+        return removed
+
+    async def _delete_notifications(self, post_uuid: str, dry_run: bool) -> int:
+        if dry_run:
+            return await db.notifications.count_documents({'post_uuid': post_uuid})
+
+        removed = 0
+        while True:
+            ids = [x['_id'] async for x in db.notifications.find({'post_uuid': post_uuid}, {'_id': 1})
+                   .limit(self.batch_size)]
+            if not ids:
+                return removed
+
+            removed += (await db.notifications.delete_many({'_id': {'$in': ids}})).deleted_count
+            await self._throttle()
+
+    async def sweep_deleted_posts(self, report: dict, dry_run: bool):
+        async for tombstone in db.deleted_posts.find({}).sort('_id', 1):
+            report['comments'] += await self._delete_comments(tombstone['uuid'], dry_run)
+            report['notifications'] += await self._delete_notifications(tombstone['uuid'], dry_run)
+            report['posts'] += 1
+
+            if not dry_run:
+                await release_image(tombstone.get('image_name'))
+                await db.deleted_posts.delete_one({'_id': tombstone['_id']})
+
+    async def sweep_orphan_comments(self, report: dict, dry_run: bool):
+        orphans = [x['_id'] async for x in db.comments.aggregate([
+            {'$group': {'_id': '$post_uuid'}},
+            {'$lookup': {'from': 'posts', 'localField': '_id', 'foreignField': 'uuid', 'as': 'posts'}},
+            {'$lookup': {'from': 'comments', 'localField': '_id', 'foreignField': 'uuid', 'as': 'parents'}},
+            {'$match': {'posts': {'$size': 0}, 'parents': {'$size': 0}}},
+            {'$project': {'_id': 1}},
+        ])]
+
+        deleted = {x['uuid'] async for x in db.deleted_posts.find({}, {'uuid': 1})}
+        for parent_uuid in orphans:
+            if parent_uuid in deleted:
+                continue
+            report['comments'] += await self._delete_comments(parent_uuid, dry_run)
+
+    async def _remove(self, name: str, path: str) -> bool:
+        trash = f'{path}.{uuid.uuid4()}.deleted'
+        await asyncio.to_thread(os.replace, path, trash)
+
+        # store_image skips writing files that already exist, so a re-upload during the sweep needs the file back
+        if await db.images.find_one({'_id': name}, {'_id': 1}):
+            await asyncio.to_thread(os.replace, trash, path)
+            return False
+
+        await asyncio.to_thread(os.remove, trash)
+        return True
+
+    async def _unlink(self, name: str, report: dict, dry_run: bool):
+        path = image_path(name)
+        try:
+            size = os.path.getsize(path)
+            if not dry_run and not await self._remove(name, path):
+                return
+        except FileNotFoundError:
+            return
+
+        report['images'] += 1
+        report['bytes'] += size
+
+    async def sweep_released_images(self, report: dict, dry_run: bool):
+        expired = {'refs': {'$lte': 0}, 'updated_at': {'$lt': time.time() - self.grace_period}}
+
+        async for image in db.images.find(expired, {'_id': 1}):
+            if not dry_run:
+                result = await db.images.delete_one({'_id': image['_id']} | expired)
+                if not result.deleted_count:
+                    continue
+            await self._unlink(image['_id'], report, dry_run)
+            await self._throttle()
+
+    async def sweep_unreferenced_files(self, report: dict, dry_run: bool):
+        referenced = set(x for x in await db.posts.distinct('image_name') if x)
+        referenced.update(x for x in await db.users.distinct('image_name') if x)
+        referenced.update([x['_id'] async for x in db.images.find({}, {'_id': 1})])
+        referenced.update([x['image_name'] async for x in db.deleted_posts.find({}, {'image_name': 1})
+                           if x.get('image_name')])
+
+        def list_files() -> typing.List[str]:
+            cutoff = time.time() - self.grace_period
+            files = []
+            for root, _, names in os.walk(IMAGEDIR):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            files.append(os.path.relpath(path, IMAGEDIR).replace(os.sep, '/'))
+                    except FileNotFoundError:
+                        pass
+            return files
+
+        for name in await asyncio.to_thread(list_files):
+            if name not in referenced:
+                await self._unlink(name, report, dry_run)
+
+    async def sweep(self, dry_run: bool = False) -> dict:
+        async with self.lock:
+            report = {'dry_run': dry_run, 'started_at': time.time(), 'posts': 0, 'comments': 0, 'notifications': 0,
+                      'images': 0, 'bytes': 0}
+
+            await self.sweep_deleted_posts(report, dry_run)
+            await self.sweep_orphan_comments(report, dry_run)
+            await self.sweep_released_images(report, dry_run)
+            await self.sweep_unreferenced_files(report, dry_run)
+
+            report['finished_at'] = time.time()
+            if not dry_run:
+                self.last_report = report
+            return report
+
+    async def run(self, interval: float = SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                logger.info('Sweep finished: %s', await self.sweep())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Sweep failed')
+
+
+sweeper = Sweeper()
@@ -0,0 +1,347 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+import typing
+
+from pymongo.errors import BulkWriteError
+
+from mongo import db
+
+logger = logging.getLogger(__name__)
+
+Handler = typing.Callable[[typing.List[dict]], typing.Awaitable[None]]
+
+
+class RetryJobs(Exception):
+    def __init__(self, payloads: typing.List[dict]):
+        super().__init__(f'{len(payloads)} jobs failed')
+        self.payloads = payloads
+
+
+class TaskQueue:
+    def __init__(self, maxsize: int = 10000, batch_size: int = 100, batch_wait: float = 0.05,
+                 max_attempts: int = 5, base_backoff: float = 1.0, workers: int = 1, restore_interval: float = 5.0):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.workers_num = workers
+        self.restore_interval = restore_interval
+
+        self.queue: asyncio.Queue | None = None
+        self.handlers: typing.Dict[str, Handler] = {}
+        self.workers: typing.List[asyncio.Task] = []
+        self.restorer: asyncio.Task | None = None
+        self.enqueued_at: typing.Deque[float] = collections.deque()
+        self.live: typing.Counter[str] = collections.Counter()
+        self.held: typing.Dict[str, typing.List[dict]] = {}
+        self.spilling: typing.Set[asyncio.Task] = set()
+        self.retrying: typing.Set[asyncio.Task] = set()
+
+        self.counters = {'enqueued': 0, 'processed': 0, 'retried': 0, 'failed': 0, 'spilled': 0, 'restored': 0}
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def handler(self, kind: str):
+        def decorator(fn: Handler) -> Handler:
+            self.handlers[kind] = fn
+            return fn
+
+        return decorator
+
+    def put(self, kind: str, **payload):
+        job = {'kind': kind, 'payload': payload, 'attempts': 0, 'enqueued_at': time.time()}
+        self.counters['enqueued'] += 1
+
+        if kind in self.held:
+            self.held[kind].append(job)
+        else:
+            self._enqueue(job)
+
+    def _enqueue(self, job: dict, requeued: bool = False) -> bool:
+        if not requeued:
+            self.live[job['kind']] += 1
+
+        try:
+            if self.queue is None:
+                raise asyncio.QueueFull
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._finish([job])
+            self._spill([job])
+            return False
+
+        self.enqueued_at.append(job['enqueued_at'])
+        return True
+
+    def _finish(self, jobs: typing.List[dict]):
+        for job in jobs:
+            self.live[job['kind']] -= 1
+
+    async def drain(self, kind: str, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while self.live[kind] > 0:
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError(f'{self.live[kind]} {kind} jobs still pending')
+            await asyncio.sleep(0.05)
+
+    @contextlib.asynccontextmanager
+    async def paused(self, kind: str, timeout: float = 30.0):
+        if kind in self.held:
+            raise RuntimeError(f'{kind} jobs are already paused')
+
+        held = self.held[kind] = []
+        try:
+            await self.drain(kind, timeout)
+            yield held
+        finally:
+            del self.held[kind]
+            for job in held:
+                self._enqueue(job)
+
+    async def _get(self, timeout: float | None = None) -> dict:
+        job = await (asyncio.wait_for(self.queue.get(), timeout) if timeout is not None else self.queue.get())
+        self.enqueued_at.popleft()
+        return job
+
+    def _get_nowait(self) -> dict:
+        job = self.queue.get_nowait()
+        self.enqueued_at.popleft()
+        return job
+
+    def _spill(self, jobs: typing.List[dict], failed: bool = False):
+        self._track(self.spilling, asyncio.create_task(self._spill_now(jobs, failed)))
+
+    async def _spill_now(self, jobs: typing.List[dict], failed: bool = False):
+        if not jobs:
+            return
+        try:
+            await db.jobs.insert_many([job | {'failed': failed, 'spilled_at': time.time()} for job in jobs])
+            self.counters['spilled'] += len(jobs)
+        except Exception:
+            logger.exception('Could not spill %d jobs', len(jobs))
+
+    @staticmethod
+    def _track(tasks: typing.Set[asyncio.Task], task: asyncio.Task):
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def restore(self, limit: int | None = None):
+        limit = limit or self.maxsize // 2
+        restored = 0
+
+        while restored < limit and self.queue.qsize() < self.maxsize:
+            job = await db.jobs.find_one_and_delete({'failed': False, 'kind': {'$nin': list(self.held)}},
+                                                    sort=[('_id', 1)])
+            if not job:
+                break
+
+            job.pop('_id', None)
+            job.pop('failed', None)
+            job.pop('spilled_at', None)
+            if not self._enqueue(job):
+                break
+            restored += 1
+
+        self.counters['restored'] += restored
+        return restored
+
+    async def _restore_spilled(self):
+        while True:
+            await asyncio.sleep(self.restore_interval)
+            room = self.maxsize // 2 - self.queue.qsize()
+            if room <= 0:
+                continue
+
+            try:
+                await self.restore(room)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not restore spilled jobs')
+
+    async def start(self):
+        if self.workers:
+            return
+
+        self.queue = asyncio.Queue(self.maxsize)
+        await self.restore()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_num)]
+        self.restorer = asyncio.create_task(self._restore_spilled())
+
+    async def stop(self, timeout: float = 10.0):
+        if not self.workers:
+            return
+
+        self.restorer.cancel()
+        await asyncio.gather(self.restorer, return_exceptions=True)
+        self.restorer = None
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+        left = []
+        while not self.queue.empty():
+            left.append(self._get_nowait())
+            self.queue.task_done()
+        self._finish(left)
+
+        for held in self.held.values():
+            left.extend(held)
+            held.clear()
+
+        retrying = list(self.retrying)
+        for task in retrying:
+            task.cancel()
+        await asyncio.gather(*retrying, return_exceptions=True)
+
+        await self._spill_now(left)
+        await asyncio.gather(*self.spilling, return_exceptions=True)
+
+    async def _next_batch(self) -> typing.List[dict]:
+        batch = [await self._get()]
+        deadline = time.monotonic() + self.batch_wait
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await self._get(timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            now = time.time()
+            self.last_lag = now - min(job['enqueued_at'] for job in batch)
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+            by_kind: typing.Dict[str, typing.List[dict]] = {}
+            for job in batch:
+                by_kind.setdefault(job['kind'], []).append(job)
+
+            try:
+                for kind, jobs in by_kind.items():
+                    await self._run(kind, jobs)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _run(self, kind: str, jobs: typing.List[dict]):
+        handler = self.handlers.get(kind)
+        if not handler:
+            logger.error('No handler for job kind %s', kind)
+            self.counters['failed'] += len(jobs)
+            self._finish(jobs)
+            await self._spill_now(jobs, failed=True)
+            return
+
+        try:
+            await handler([job['payload'] for job in jobs])
+            self.counters['processed'] += len(jobs)
+            self._finish(jobs)
+        except asyncio.CancelledError:
+            raise
+        except RetryJobs as e:
+            failed = {id(payload) for payload in e.payloads}
+            logger.warning('%d of %d %s jobs failed', len(failed), len(jobs), kind)
+            done = [job for job in jobs if id(job['payload']) not in failed]
+            self.counters['processed'] += len(done)
+            self._finish(done)
+            for job in jobs:
+                if id(job['payload']) in failed:
+                    self._retry(job)
+        except Exception:
+            logger.exception('Job batch %s failed', kind)
+            for job in jobs:
+                self._retry(job)
+
+    def _retry(self, job: dict):
+        job['attempts'] += 1
+        if job['attempts'] >= self.max_attempts:
+            self.counters['failed'] += 1
+            self._finish([job])
+            self._spill([job], failed=True)
+            return
+
+        self.counters['retried'] += 1
+        delay = self.base_backoff * 2 ** (job['attempts'] - 1)
+        self._track(self.retrying, asyncio.create_task(self._requeue(job, delay)))
+
+    async def _requeue(self, job: dict, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._finish([job])
+            await self._spill_now([job])
+            raise
+
+        self._enqueue(job, requeued=True)
+
+    def stats(self) -> dict:
+        depth = self.queue.qsize() if self.queue else 0
+        oldest = self.enqueued_at[0] if self.enqueued_at else None
+
+        return self.counters | {
+            'depth': depth,
+            'capacity': self.maxsize,
+            'lag': time.time() - oldest if oldest else 0.0,
+            'last_batch_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'retrying': len(self.retrying),
+            'held': {kind: len(jobs) for kind, jobs in self.held.items()},
+        }
+
+
+task_queue = TaskQueue()
+
+
+@task_queue.handler('notify')
+async def insert_notifications(jobs: typing.List[dict]):
+    flags = {}
+    for job in jobs:
+        flags.setdefault(job['user_uuid'], set()).add(job['flag'])
+
+    enabled = {}
+    async for user in db.users.find({'uuid': {'$in': list(flags)}},
+                                    {'uuid': 1, **{flag: 1 for user_flags in flags.values() for flag in user_flags}}):
+        enabled[user['uuid']] = {flag for flag in flags[user['uuid']] if user.get(flag)}
+
+    notifications = [
+        {
+            '_id': job['id'],
+            'user_uuid': job['user_uuid'],
+            'from_uuid': job['from_uuid'],
+            'post_uuid': job.get('post_uuid'),
+            'type': job['flag'],
+            'avatar': job['avatar'],
+            'user_name': job['user_name'],
+            'text': job['text'],
+            'date': job['date'],
+        }
+        for job in jobs if job['flag'] in enabled.get(job['user_uuid'], ())
+    ]
+
+    if not notifications:
+        return
+
+    try:
+        await db.notifications.insert_many(notifications, ordered=False)
+    except BulkWriteError as e:
+        # a retried batch may be partially inserted already
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
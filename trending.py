@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import logging
+import time
+import typing
+
+import pymongo
+
+from mongo import db
+from utils import published_filter
+
+logger = logging.getLogger(__name__)
+
+LIKE_WEIGHT = 3.0
+COMMENT_WEIGHT = 2.0
+VIEW_WEIGHT = 0.1
+GRAVITY = 1.5
+
+TREND_WINDOW = 7 * 24 * 60 * 60
+REFRESH_INTERVAL = 15
+REBUILD_INTERVAL = 10 * 60
+TOP_K = 500
+
+SCORE_PROJECTION = {'uuid': 1, 'likes': 1, 'views': 1, 'publication_time': 1, 'moderated': 1,
+                    'timestamp_to_publish': 1}
+
+
+def seconds(timestamp: int | None) -> float:
+    timestamp = timestamp or 0
+    return timestamp / 1000 if timestamp > 10 ** 11 else timestamp
+
+
+def score(likes: int, views: int, comments: int, publication_time: int, now: float) -> float:
+    points = (likes or 0) * LIKE_WEIGHT + comments * COMMENT_WEIGHT + (views or 0) * VIEW_WEIGHT
+    age_hours = max(0.0, now - seconds(publication_time)) / 3600
+    return points / (age_hours + 2) ** GRAVITY
+
+
+async def comment_counts(post_uuids: typing.List[str]) -> typing.Dict[str, int]:
+    counts = {}
+    async for x in db.comments.aggregate([
+        {'$match': {'post_uuid': {'$in': post_uuids}}},
+        {'$group': {'_id': '$post_uuid', 'count': {'$sum': 1}}}
+    ]):
+        counts[x['_id']] = x['count']
+    return counts
+
+
+class TrendingIndex:
+    def __init__(self, top_k: int = TOP_K):
+        self.top_k = top_k
+        self.scores: typing.Dict[str, float] = {}
+        self.top: typing.List[str] = []
+        self.dirty: typing.Set[str] = set()
+        self.rebuilt_at = 0.0
+        self.task: asyncio.Task | None = None
+
+    def touch(self, post_uuid: str):
+        self.dirty.add(post_uuid)
+
+    def discard(self, post_uuid: str):
+        self.dirty.discard(post_uuid)
+        if self.scores.pop(post_uuid, None) is not None:
+            self.top = [x for x in self.top if x != post_uuid]
+
+    def _trim(self):
+        best = heapq.nlargest(self.top_k, self.scores.items(), key=lambda x: x[1])
+        self.scores = {uuid: value for uuid, value in best if value > 0}
+        self.top = [uuid for uuid, value in best if value > 0]
+
+    async def _score_posts(self, posts: typing.List[dict], now: float) -> typing.Dict[str, float]:
+        counts = await comment_counts([x['uuid'] for x in posts])
+        published_before = now * 1000
+        return {
+            x['uuid']: score(x.get('likes'), x.get('views'), counts.get(x['uuid'], 0), x.get('publication_time'), now)
+            if x.get('moderated') and (x.get('timestamp_to_publish') or 0) <= published_before
+               and now - seconds(x.get('publication_time')) <= TREND_WINDOW else 0.0
+            for x in posts
+        }
+
+    async def refresh(self) -> int:
+        if not self.dirty:
+            return 0
+
+        post_uuids, self.dirty = list(self.dirty), set()
+        now = time.time()
+        posts = [x async for x in db.posts.find({'uuid': {'$in': post_uuids}}, SCORE_PROJECTION)]
+        scores = await self._score_posts(posts, now)
+
+        if scores:
+            await db.posts.bulk_write([pymongo.UpdateOne({'uuid': uuid}, {'$set': {'trend_score': value}})
+                                       for uuid, value in scores.items()], ordered=False)
+
+        self.scores.update(scores)
+        self._trim()
+        return len(scores)
+
+    async def rebuild(self, batch_size: int = 500) -> int:
+        now = time.time()
+        self.dirty.clear()
+        scores: typing.Dict[str, float] = {}
+
+        batch = []
+        async for x in db.posts.find(published_filter() | {'publication_time': {'$gte': int(now - TREND_WINDOW)}},
+                                     SCORE_PROJECTION):
+            batch.append(x)
+            if len(batch) >= batch_size:
+                scores.update(await self._score_posts(batch, now))
+                batch = []
+        if batch:
+            scores.update(await self._score_posts(batch, now))
+
+        requests = [pymongo.UpdateOne({'uuid': uuid}, {'$set': {'trend_score': value}})
+                    for uuid, value in scores.items()]
+        for i in range(0, len(requests), batch_size):
+            await db.posts.bulk_write(requests[i:i + batch_size], ordered=False)
+
+        await db.posts.update_many({'trend_score': {'$gt': 0}, 'uuid': {'$nin': list(scores)}},
+                                   {'$set': {'trend_score': 0}})
+
+        self.scores = scores
+        self._trim()
+        self.rebuilt_at = now
+        return len(scores)
+
+    def page(self, offset: int, count: int) -> typing.List[str] | None:
+        if offset + count > len(self.top) and len(self.top) >= self.top_k:
+            return None
+        return self.top[offset:offset + count]
+
+    async def _run(self):
+        while True:
+            try:
+                if time.time() - self.rebuilt_at >= REBUILD_INTERVAL:
+                    await self.rebuild()
+                else:
+                    await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Trending update failed')
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def stats(self) -> dict:
+        return {'tracked': len(self.scores), 'dirty': len(self.dirty), 'rebuilt_at': self.rebuilt_at}
+
+
+trending = TrendingIndex()
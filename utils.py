@@ -0,0 +1,23 @@
+import html
+import re
+import time
+
+EXCERPT_LENGTH = 300
+
+_tags_re = re.compile(r'<[^>]+>')
+_spaces_re = re.compile(r'\s+')
+
+
+def make_excerpt(text: str | None, length: int = EXCERPT_LENGTH) -> str:
+    plain = _spaces_re.sub(' ', html.unescape(_tags_re.sub(' ', text or ''))).strip()
+    if len(plain) <= length:
+        return plain
+
+    cut = plain[:length]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip(' .,;:!?-—') + '…'
+
+
+def published_filter() -> dict:
+    return {'moderated': True, 'timestamp_to_publish': {'$lte': int(time.time() * 1000)}}